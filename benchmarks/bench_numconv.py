@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+""" Compare chunked NumConv conversions with the per-digit implementation.
+
+    Usage::
+
+        python benchmarks/bench_numconv.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from mcutils import BASE62, BASE85, NumConv
+
+
+class PerDigitNumConv(NumConv):
+    """ Conversions as they were implemented before chunking. """
+
+    def int2str(self, num):
+        if int(num) != num:
+            raise TypeError('number must be an integer')
+        if num < 0:
+            raise ValueError('number must be positive')
+        radix, alphabet = self.radix, self.alphabet
+        if (radix in (8, 10, 16) and
+                alphabet[:radix].lower() == BASE85[:radix].lower()):
+            return ({8: '%o', 10: '%d', 16: '%x'}[radix] % num).upper()
+        ret = ''
+        while True:
+            ret = alphabet[num % radix] + ret
+            if num < radix:
+                break
+            num //= radix
+        return ret
+
+    def str2int(self, num):
+        radix, alphabet = self.radix, self.alphabet
+        if radix <= 36 and alphabet[:radix].lower() == BASE85[:radix].lower():
+            return int(num, radix)
+        ret = 0
+        lalphabet = alphabet[:radix]
+        for char in num:
+            if char not in lalphabet:
+                raise ValueError("invalid literal for radix2int() with radix "
+                    "%d: '%s'" % (radix, num))
+            ret = ret * radix + self.cached_map[char]
+        return ret
+
+
+def bench(func, number):
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e6
+
+
+def main():
+    random.seed(0)
+    print('%-8s %6s %14s %14s %8s' % (
+        'alphabet', 'bits', 'per-digit, us', 'chunked, us', 'speedup'))
+    for name, radix, alphabet in (('BASE62', 62, BASE62),
+                                  ('BASE85', 85, BASE85)):
+        conv = NumConv(radix, alphabet)
+        old_conv = PerDigitNumConv(radix, alphabet)
+        for bits, number in ((64, 20000), (128, 10000), (4096, 200)):
+            num = random.getrandbits(bits) | (1 << (bits - 1))
+            text = conv.int2str(num)
+            assert text == old_conv.int2str(num)
+            assert conv.str2int(text) == old_conv.str2int(text) == num
+            for op, old, new in (
+                    ('int2str',
+                     lambda: old_conv.int2str(num),
+                     lambda: conv.int2str(num)),
+                    ('str2int',
+                     lambda: old_conv.str2int(text),
+                     lambda: conv.str2int(text))):
+                old_time, new_time = bench(old, number), bench(new, number)
+                print('%-8s %6d %14.2f %14.2f %7.1fx  %s' % (
+                    name, bits, old_time, new_time, old_time / new_time, op))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+""" Compare mcutils.text.slugify with Django's slugify of unidecode'd text.
+
+    Usage::
+
+        python benchmarks/bench_slugify.py
+"""
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+settings.configure()
+from django.utils.text import slugify as django_slugify
+from unidecode import unidecode
+
+from mcutils import text
+
+WORDS = (u'Hello', u'World', u'caf\xe9', u'na\xefve', u'Stra\xdfe',
+    u'Привет', u'мир',
+    u'Αθήνα', u'2015', u'&', u'--', u'Title!')
+
+
+def old_slugify(value):
+    return django_slugify(unicode(unidecode(value)))
+
+
+def bench(func, values, number):
+    def run():
+        for value in values:
+            func(value)
+    return min(timeit.repeat(run, number=number, repeat=3)) / (
+        number * len(values)) * 1e6
+
+
+def main():
+    random.seed(0)
+    titles = [u' '.join(random.choice(WORDS) for i in range(6))
+        for j in range(5000)]
+    for title in titles:
+        assert text.slugify(title) == old_slugify(title)
+    print('%-16s %14s %14s %8s' % (
+        'titles', 'django, us', 'mcutils, us', 'speedup'))
+    for name, values, slugify in (
+            ('unique', titles, text._slugify),
+            ('repeated', titles[:100], text.slugify)):
+        old_time = bench(old_slugify, values, 5)
+        new_time = bench(slugify, values, 5)
+        print('%-16s %14.2f %14.2f %7.1fx' % (
+            name, old_time, new_time, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
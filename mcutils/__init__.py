@@ -1,6 +1,25 @@
+import binascii
+import collections
+import os
+import sys
+import threading
+
 # number of bytes taken from /dev/urandom
 RANDOM_ID_SOURCE_BYTES = 7
 
+# number of bytes read from /dev/urandom at once by the entropy pool
+ENTROPY_POOL_SIZE = 4096
+
+# maximum number of shared converters kept by :func:`get_numconv`
+NUMCONV_CACHE_SIZE = 32
+
+# maximum number of entries in NumConv digit-group tables
+NUMCONV_GROUP_TABLE_SIZE = 4096
+
+# strings longer than this number of chunks are decoded by splitting them
+# in halves recursively (benefits from Karatsuba multiplication)
+NUMCONV_SPLIT_THRESHOLD = 32
+
 # from april fool's rfc 1924
 BASE85 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz' \
     '!#$%&()*+-;<=>?@^_`{|}~'
@@ -44,6 +63,79 @@ class NumConv(object):
         if len(self.cached_map) != len(self.alphabet):
             raise ValueError("duplicate characters found in '%s'" % (
                 self.alphabet, ))
+        # lookup tables for both directions, limited to the used digits
+        self.digits = tuple(alphabet[:radix])
+        self.digit_map = dict(zip(self.digits, range(radix)))
+        # pick built-in conversions once instead of on every call
+        self._int_format = None
+        if (radix in (8, 10, 16) and
+                alphabet[:radix].lower() == BASE85[:radix].lower()):
+            self._int_format = {8: '%o', 10: '%d', 16: '%x'}[radix]
+        self._builtin_str2int = (radix <= 36 and
+            alphabet[:radix].lower() == BASE85[:radix].lower())
+        # numbers are converted in chunks of `chunk_digits` digits, each
+        # chunk fits a machine word and is made of `group_digits` groups
+        # looked up in precomputed tables (built on first use)
+        self.group_digits = 1
+        while radix ** (self.group_digits + 1) <= NUMCONV_GROUP_TABLE_SIZE:
+            self.group_digits += 1
+        self.group_base = radix ** self.group_digits
+        self.chunk_digits = self.group_digits
+        while self.group_base ** (
+                self.chunk_digits // self.group_digits + 1) <= sys.maxsize:
+            self.chunk_digits += self.group_digits
+        self.chunk_base = radix ** self.chunk_digits
+        self._group_table = None
+        self._group_map = None
+        self._powers = [self.chunk_base]
+        # shorter values are faster to convert digit by digit
+        self.chunked_min_value = self.chunk_base ** 2
+        self.chunked_min_length = self.chunk_digits * 4
+
+    def _build_group_tables(self):
+        digits, size = self.digits, self.group_digits
+        table = ['']
+        for i in range(size):
+            table = [prefix + digit for prefix in table for digit in digits]
+        self._group_map = dict(zip(table, range(len(table))))
+        self._group_table = tuple(table)
+
+    def _power(self, i):
+        """ Returns ``chunk_base ** (2 ** i)``. """
+        powers = self._powers
+        while len(powers) <= i:
+            powers = powers + [powers[-1] * powers[-1]]
+        self._powers = powers
+        return powers[i]
+
+    def _str2int_split(self, num, i):
+        """ Divide and conquer decoding, the lower half of *num* is
+        ``chunk_digits * 2 ** i`` characters long.
+        """
+        if len(num) <= self.chunk_digits * NUMCONV_SPLIT_THRESHOLD:
+            return self._str2int_chunked(num)
+        width = self.chunk_digits << i
+        while len(num) <= width:
+            i -= 1
+            width >>= 1
+        return (self._str2int_split(num[:-width], i) * self._power(i) +
+                self._str2int_split(num[-width:], i - 1))
+
+    def _str2int_chunked(self, num):
+        radix, digit_map = self.radix, self.digit_map
+        group_map = self._group_map
+        chunk_digits, chunk_base = self.chunk_digits, self.chunk_base
+        size, group_base = self.group_digits, self.group_base
+        head = len(num) % chunk_digits or chunk_digits
+        ret = 0
+        for char in num[:head]:
+            ret = ret * radix + digit_map[char]
+        for start in range(head, len(num), chunk_digits):
+            chunk = 0
+            for i in range(start, start + chunk_digits, size):
+                chunk = chunk * group_base + group_map[num[i:i + size]]
+            ret = ret * chunk_base + chunk
+        return ret
 
     def int2str(self, num):
         """ Converts an integer into a string.
@@ -80,16 +172,35 @@ class NumConv(object):
             raise TypeError('number must be an integer')
         if num < 0:
             raise ValueError('number must be positive')
-        radix, alphabet = self.radix, self.alphabet
-        if (radix in (8, 10, 16) and
-                alphabet[:radix].lower() == BASE85[:radix].lower()):
-            return ({8: '%o', 10: '%d', 16: '%x'}[radix] % num).upper()
+        if self._int_format is not None:
+            return (self._int_format % num).upper()
+        radix, digits = self.radix, self.digits
+        chunks = None
+        if num >= self.chunked_min_value:
+            # peel off a machine word worth of digits per big-int division
+            # and convert it using the digit-group table
+            if self._group_table is None:
+                self._build_group_tables()
+            table, group_base = self._group_table, self.group_base
+            chunk_base, groups = self.chunk_base, range(
+                self.chunk_digits // self.group_digits)
+            chunks = []
+            while num >= chunk_base:
+                num, rem = divmod(num, chunk_base)
+                rem = int(rem)
+                for i in groups:
+                    rem, group = divmod(rem, group_base)
+                    chunks.append(table[group])
+            chunks.reverse()
+            num = int(num)
         ret = ''
         while True:
-            ret = alphabet[num % radix] + ret
+            ret = digits[num % radix] + ret
             if num < radix:
                 break
             num //= radix
+        if chunks:
+            return ret + ''.join(chunks)
         return ret
 
     def str2int(self, num):
@@ -122,18 +233,167 @@ class NumConv(object):
             :rtype: integer
             :raise ValueError: when *num* is invalid
         """
-        radix, alphabet = self.radix, self.alphabet
-        if radix <= 36 and alphabet[:radix].lower() == BASE85[:radix].lower():
+        radix = self.radix
+        if self._builtin_str2int:
             return int(num, radix)
+        if len(num) > self.chunked_min_length:
+            if self._group_table is None:
+                self._build_group_tables()
+            try:
+                return self._str2int_split(num, len(num).bit_length())
+            except KeyError:
+                raise ValueError("invalid literal for radix2int() with radix "
+                    "%d: '%s'" % (radix, num))
         ret = 0
-        lalphabet = alphabet[:radix]
+        digit_map = self.digit_map
         for char in num:
-            if char not in lalphabet:
+            try:
+                ret = ret * radix + digit_map[char]
+            except KeyError:
                 raise ValueError("invalid literal for radix2int() with radix "
                     "%d: '%s'" % (radix, num))
-            ret = ret * radix + self.cached_map[char]
         return ret
 
+    def int2str_many(self, nums, width=None):
+        """ Converts a sequence of integers into a list of strings.
+
+            When NumPy is available, sequences and arrays of unsigned 64-bit
+            integers are converted column-wise: one vectorized division per
+            digit position for all values at once.  Otherwise (or for values
+            which do not fit 64 bits) :meth:`int2str` is applied to every
+            value.
+
+            Example usage:
+
+            .. code-block:: python
+
+               >> NumConv(62, BASE62).int2str_many([0, 61, 62])
+               ['0', 'z', '10']
+
+               >> NumConv(62, BASE62).int2str_many([0, 61, 62], width=3)
+               ['000', '00z', '010']
+
+            :param nums: a sequence or NumPy array of integers.
+            :param width: if specified, strings are left padded with the
+                zero digit to be at least *width* characters long.
+            :returns: list of strings
+            :raise TypeError: when *nums* contains non-integer values
+            :raise ValueError: when *nums* contains negative values
+        """
+        numpy = _get_numpy()
+        if numpy is not None and self._int_format is None and (
+                '\0' not in self.digits):
+            values = numpy.asarray(nums)
+            if values.dtype.kind in 'ui' and values.dtype.itemsize <= 8:
+                if values.dtype.kind == 'i' and (values < 0).any():
+                    raise ValueError('number must be positive')
+                return self._int2str_many_numpy(
+                    numpy, values.astype(numpy.uint64).ravel(), width)
+            if isinstance(nums, numpy.ndarray):
+                nums = nums.ravel().tolist()
+        if width:
+            zero = self.digits[0]
+            return [self.int2str(num).rjust(width, zero) for num in nums]
+        return [self.int2str(num) for num in nums]
+
+    def _int2str_many_numpy(self, numpy, nums, width):
+        radix = numpy.uint64(self.radix)
+        digits = numpy.array(self.digits)
+        # number of digits of every value, zero is written as a single digit
+        lengths = numpy.ones(len(nums), dtype=numpy.intp)
+        columns = []
+        while True:
+            nums, rem = numpy.divmod(nums, radix)
+            columns.append(digits[rem])
+            if not nums.any():
+                break
+            lengths += nums > 0
+        while len(columns) < width:
+            columns.append(numpy.repeat(digits[:1], len(nums)))
+        columns.reverse()
+        size = len(columns)
+        chars = numpy.ascontiguousarray(numpy.column_stack(columns))
+        strings = chars.view('%s%d' % (chars.dtype.char, size)).ravel()
+        strings = strings.tolist()
+        if width and width >= size:
+            return strings
+        lengths = numpy.maximum(lengths, width or 0)
+        return [value[size - length:]
+                for value, length in zip(strings, lengths.tolist())]
+
+    def str2int_many(self, values):
+        """ Converts a sequence of strings into a list of integers.
+
+            When NumPy is available, strings are decoded column-wise: the
+            values are left padded with the zero digit to a common width
+            and every digit position is processed for all strings at once.
+            Fixed-width strings, like those returned by
+            :meth:`int2str_many` with *width* specified, need no padding.
+
+            Example usage:
+
+            .. code-block:: python
+
+               >> NumConv(62, BASE62).str2int_many(['000', '00z', '010'])
+               [0, 61, 62]
+
+            :param values: a sequence or NumPy array of strings.
+            :returns: list of integers
+            :raise ValueError: when any of *values* is invalid
+        """
+        numpy = _get_numpy()
+        if (numpy is None or self._builtin_str2int or
+                '\0' in self.digits or not len(values)):
+            return [self.str2int(value) for value in values]
+        values = numpy.asarray(values)
+        if values.dtype.kind not in 'SU':
+            return [self.str2int(value) for value in values.tolist()]
+        values = values.ravel()
+        lengths = numpy.char.str_len(values)
+        width = int(lengths.max())
+        if not width:
+            return [self.str2int(value) for value in values.tolist()]
+        if (lengths != width).any():
+            values = numpy.char.rjust(values, width, self.digits[0])
+        values = numpy.ascontiguousarray(values, dtype='%s%d' % (
+            values.dtype.char, width))
+        if values.dtype.kind == 'S':
+            codes = values.view(numpy.uint8)
+        else:
+            codes = values.view(numpy.uint32)
+        codes = codes.reshape(len(values), width)
+        # dense lookup table from character codes to digit values
+        size = max(ord(digit) for digit in self.digits) + 1
+        table = numpy.empty(size + 1, dtype=numpy.int64)
+        table.fill(-1)
+        table[[ord(digit) for digit in self.digits]] = numpy.arange(
+            self.radix)
+        digits = table[numpy.minimum(codes, size)]
+        invalid = (digits < 0).any(axis=1)
+        if invalid.any():
+            num = values[invalid.argmax()]
+            raise ValueError("invalid literal for radix2int() with radix "
+                "%d: '%s'" % (self.radix, num))
+        # split columns into segments which do not overflow 64 bits
+        radix = numpy.uint64(self.radix)
+        segment = 1
+        while self.radix ** (segment + 1) <= 2 ** 64:
+            segment += 1
+        ret = None
+        for start in range(0, width, segment):
+            stop = min(start + segment, width)
+            value = numpy.zeros(len(values), dtype=numpy.uint64)
+            for i in range(start, stop):
+                value = value * radix + digits[:, i].astype(numpy.uint64)
+            if ret is None:
+                ret = value
+            else:
+                if ret.dtype != object:
+                    ret = ret.astype(object)
+                ret = ret * (self.radix ** (stop - start)) + value.astype(
+                    object)
+        return ret.tolist()
+
 
 class Final(type):
     """ Metaclass for 'sealed' classes. A sealed class cannot be extended.
@@ -159,14 +419,55 @@ def datetime_as_iso(value):
     return retval
 
 
+_numpy = None
+
+
+def _get_numpy():
+    """ Returns ``numpy`` module or None if it is not installed. """
+    global _numpy
+    if _numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+        _numpy = numpy
+    return _numpy or None
+
+
+_numconv_cache = collections.OrderedDict()
+_numconv_lock = threading.Lock()
+
+
+def get_numconv(radix=10, alphabet=BASE85):
+    """ Get shared :class:`NumConv` instance for given *radix* and *alphabet*.
+
+        Converters are kept in a bounded registry (see
+        :data:`NUMCONV_CACHE_SIZE`), the oldest one is dropped when the
+        registry is full. Hot loops may keep the returned object to skip
+        the registry lookup as well::
+
+            b62 = get_numconv(62, BASE62)
+            slugs = [b62.int2str(pk) for pk in pks]
+    """
+    key = (radix, alphabet)
+    conv = _numconv_cache.get(key)
+    if conv is None:
+        conv = NumConv(radix, alphabet)
+        with _numconv_lock:
+            conv = _numconv_cache.setdefault(key, conv)
+            while len(_numconv_cache) > NUMCONV_CACHE_SIZE:
+                _numconv_cache.popitem(last=False)
+    return conv
+
+
 def int2str(num, radix=10, alphabet=BASE85):
     """ Helper for quick base conversions from integers to strings """
-    return NumConv(radix, alphabet).int2str(num)
+    return get_numconv(radix, alphabet).int2str(num)
 
 
 def str2int(num, radix=10, alphabet=BASE85):
     """ Helper for quick base conversions from strings to integers. """
-    return NumConv(radix, alphabet).str2int(num)
+    return get_numconv(radix, alphabet).str2int(num)
 
 
 def clean_int(value, default, min_value=None, max_value=None):
@@ -235,44 +536,176 @@ def multi_split(s, seps):
     return v.split(sep)
 
 
+_process_locks = {}
+
+
+def _get_process_lock():
+    """ Returns lock of the current process.  A lock inherited from the
+    parent may be held by a thread which does not exist in the child
+    process, so every process gets its own one.  The lock is reentrant,
+    as resetting one object may reset others it uses.
+    """
+    pid = os.getpid()
+    lock = _process_locks.get(pid)
+    if lock is None:
+        # setdefault is atomic, racing threads get the same lock
+        lock = _process_locks.setdefault(pid, threading.RLock())
+    return lock
+
+
+class _ProcessLocal(object):
+    """ Base of objects with state which must not be shared with forked
+    child processes.  Subclasses implement :meth:`_reset`, which sets up
+    the state (including locks, which may be held by a thread which does
+    not exist in the child process), and call :meth:`_check_pid` before
+    using the state.
+    """
+
+    _pid = None
+
+    def _reset(self):
+        raise NotImplementedError
+
+    def _check_pid(self, force=False):
+        """ Calls :meth:`_reset` once in every process, or now if *force*
+        is true.
+        """
+        pid = os.getpid()
+        if force or self._pid != pid:
+            with _get_process_lock():
+                if force or self._pid != pid:
+                    self._reset()
+                    self._pid = pid
+
+
+class EntropyPool(_ProcessLocal):
+    """ Thread-safe buffer of random bytes.
+
+        Bytes are read from ``os.urandom`` in blocks of *size* bytes and
+        handed out in slices, so that many small requests cost a single
+        system call.  The buffer is dropped in a forked child process, so
+        that parent and child never share random data.
+
+        The pool keeps random data in process memory, use it for
+        identifiers rather than for cryptographic keys.
+
+        :param size: number of bytes read from ``os.urandom`` at once.
+    """
+
+    def __init__(self, size=ENTROPY_POOL_SIZE):
+        self.size = size
+        self._check_pid()
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._buffer = b''
+        self._offset = 0
+
+    def read(self, n):
+        """ Returns *n* random bytes. """
+        self._check_pid()
+        with self._lock:
+            offset = self._offset
+            if offset + n > len(self._buffer):
+                if n > self.size:
+                    return os.urandom(n)
+                self._buffer = self._buffer[offset:] + os.urandom(self.size)
+                offset = 0
+            self._offset = offset + n
+            return self._buffer[offset:offset + n]
+
+    def getrandint(self, n):
+        """ Returns random integer made of *n* random bytes. """
+        return int(binascii.hexlify(self.read(n)), 16)
+
+    def getrandints(self, count, n):
+        """ Returns list of *count* random integers of *n* bytes each. """
+        data = binascii.hexlify(self.read(count * n))
+        n *= 2
+        return [int(data[i:i + n], 16) for i in range(0, len(data), n)]
+
+
+entropy_pool = EntropyPool()
+
+
 def _random(bytes):
     """ Get random bytes and convert them to integer. """
-    import os
-    table = ''.join(chr(i) for i in range(256))
-    return str2int(os.urandom(bytes), 256, table)
+    return entropy_pool.getrandint(bytes)
 
 
-def random_in_range(max_value, min_value=0):
-    """ See How to generate a random number from within a range - C
-    http://goo.gl/aWiZX
-    """
-    def numbits(x):
-        """ Python before 2.7 does not have Long.bit_length method. """
-        try:
-            return x.bit_length()
-        except AttributeError:
-            return len(bin(abs(x))) - 2
+def _numbits(x):
+    """ Python before 2.7 does not have Long.bit_length method. """
+    try:
+        return x.bit_length()
+    except AttributeError:
+        return len(bin(abs(x))) - 2
+
 
+def _random_in_range_params(max_value, min_value):
+    """ Returns parameters of rejection sampling for given range: number
+    of random bytes per sample, bit shift applied to them, upper limit for
+    accepted samples and size of the bucket mapped to a single value.
+    """
     if not max_value:
         max_value = 2L ** 64 - 1
-    bit_length = numbits(max_value)
+    bit_length = _numbits(max_value)
     rand_max = 2L ** bit_length - 1
-    import random
-    r = random.SystemRandom()
-    base_random = r.getrandbits(bit_length)
+    value_range = max_value - min_value
+    bucket = rand_max // value_range
+    # samples equal to or above the limit would make distribution uneven
+    limit = rand_max - rand_max % value_range
+    size = (bit_length + 7) // 8
+    return size, size * 8 - bit_length, limit, bucket
 
-    # base_random in [0, RAND_MAX]
-    if rand_max == base_random:
-        return random_in_range(max_value=max_value, min_value=min_value)
 
-    # now guaranteed to be in [0, RAND_MAX)
-    value_range = max_value - min_value
-    remainder = rand_max % value_range
-    bucket = rand_max / value_range
+def random_in_range(max_value, min_value=0):
+    """ See How to generate a random number from within a range - C
+    http://goo.gl/aWiZX
+    """
+    size, shift, limit, bucket = _random_in_range_params(max_value, min_value)
+    while True:
+        base_random = entropy_pool.getrandint(size) >> shift
+        if base_random < limit:
+            return min_value + base_random // bucket
+
 
-    if base_random < rand_max - remainder:
-        return min_value + base_random / bucket
-    return random_in_range(max_value=max_value, min_value=min_value)
+def random_in_range_many(n, max_value=None, min_value=0):
+    """ Get list of *n* random integers within a range.
+
+        Same as calling :func:`random_in_range` *n* times, but random data
+        for all samples is taken at once and rejected samples are filtered
+        out in bulk (using NumPy when it is installed).
+    """
+    size, shift, limit, bucket = _random_in_range_params(max_value, min_value)
+    numpy = _get_numpy()
+    if numpy is None or size > 8:
+        numpy = None
+    ret = []
+    while len(ret) < n:
+        needed = n - len(ret)
+        # draw enough samples to cover expected rejections
+        count = needed * (2L ** (size * 8 - shift)) // limit + 8
+        if numpy is None:
+            values = [value >> shift
+                for value in entropy_pool.getrandints(count, size)]
+            ret.extend(min_value + value // bucket
+                for value in values if value < limit)
+            continue
+        data = numpy.frombuffer(entropy_pool.read(count * size),
+            dtype=numpy.uint8).reshape(count, size)
+        values = numpy.zeros((count, 8), dtype=numpy.uint8)
+        values[:, 8 - size:] = data
+        values = values.view('>u8').ravel().astype(numpy.uint64)
+        values >>= numpy.uint64(shift)
+        values = values[values < numpy.uint64(limit)]
+        values //= numpy.uint64(bucket)
+        if min_value >= 0:
+            values += numpy.uint64(min_value)
+            ret.extend(values.tolist())
+        else:
+            ret.extend(min_value + value for value in values.tolist())
+    del ret[n:]
+    return ret
 
 
 def get_random_id():
@@ -280,6 +713,11 @@ def get_random_id():
     return _random(RANDOM_ID_SOURCE_BYTES)
 
 
+def get_random_ids(n):
+    """ Get list of *n* random integers suitable for database IDs. """
+    return entropy_pool.getrandints(n, RANDOM_ID_SOURCE_BYTES)
+
+
 def get_random_id_str(alphabet=None):
     """ Get random integer and encode it to URL-safe string. """
     if not alphabet:
@@ -288,6 +726,14 @@ def get_random_id_str(alphabet=None):
     return int2str(n, len(alphabet), alphabet)
 
 
+def get_random_id_strs(n, alphabet=None):
+    """ Get list of *n* random integers encoded to URL-safe strings. """
+    if not alphabet:
+        alphabet = BASE62
+    conv = get_numconv(len(alphabet), alphabet)
+    return conv.int2str_many(get_random_ids(n))
+
+
 def get_unique_id(is_unique=None):
     """ Get unique integer value suitable for use as a database key.
 
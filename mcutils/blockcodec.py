@@ -0,0 +1,214 @@
+""" Streaming base-N encoding of binary data.
+
+    Data is split into blocks of *block_size* bytes, every block is treated
+    as a big-endian integer and written with a fixed number of characters
+    of the alphabet.  The last block may be shorter, it is written with as
+    few characters as needed to hold its bytes, so the length of encoded
+    text always tells how many bytes were encoded.
+
+    With the default block sizes :data:`~mcutils.BASE64` and
+    :data:`~mcutils.BASE32` encoded full blocks are the same as RFC 4648
+    ones, but the encoded text is never padded.
+
+    Usage::
+
+        from mcutils import BASE62
+        from mcutils.blockcodec import decode_stream, encode_stream
+
+        with open(path, 'rb') as f:
+            for text in encode_stream(f, BASE62):
+                response.write(text)
+"""
+import binascii
+
+from . import BASE62, _get_numpy, get_numconv
+
+__all__ = ['BlockCodec', 'decode', 'decode_stream', 'encode', 'encode_stream']
+
+
+# number of bytes read from the stream at once
+CHUNK_SIZE = 64 * 1024
+
+# maximum size of block chosen automatically
+MAX_BLOCK_SIZE = 8
+
+
+class BlockCodec(object):
+    """ Block encoder/decoder for the given alphabet.
+
+        :param alphabet: encoding alphabet, all of its characters are used.
+        :param block_size: number of bytes encoded at once.  When not
+            specified, the most compact block size up to
+            :data:`MAX_BLOCK_SIZE` bytes is chosen, e.g. 4 bytes for
+            :data:`~mcutils.BASE85`, 3 bytes for :data:`~mcutils.BASE64`,
+            5 bytes for :data:`~mcutils.BASE32` and 8 bytes for
+            :data:`~mcutils.BASE62`.
+
+        :raise ValueError: when *alphabet* is longer than 256 characters
+            or has duplicated characters
+    """
+
+    def __init__(self, alphabet=BASE62, block_size=None):
+        radix = len(alphabet)
+        if radix > 256:
+            raise ValueError('alphabet must be at most 256 characters long')
+        self.conv = get_numconv(radix, alphabet)
+        # number of characters needed to encode k bytes is widths[k]
+        widths = [0]
+        for size in range(1, (block_size or MAX_BLOCK_SIZE) + 1):
+            width = widths[-1]
+            while radix ** width < 256 ** size:
+                width += 1
+            widths.append(width)
+        if block_size is None:
+            block_size = min(range(1, len(widths)),
+                key=lambda size: (widths[size] * 1.0 / size, size))
+        self.block_size = block_size
+        self.widths = widths[:block_size + 1]
+        self.block_width = self.widths[-1]
+        self.sizes = dict((width, size)
+            for size, width in enumerate(self.widths))
+
+    def encode(self, data):
+        """ Encodes bytes (or any buffer) and returns a string. """
+        return ''.join(self.encode_stream(data))
+
+    def decode(self, text):
+        """ Decodes a string and returns bytes.
+
+            :raise ValueError: when *text* is invalid
+        """
+        return b''.join(self.decode_stream(text))
+
+    def encode_stream(self, stream, chunk_size=CHUNK_SIZE):
+        """ Generator which yields encoded text of the *stream*.
+
+            :param stream: file-like object opened in binary mode or any
+                object supporting the buffer protocol (``bytes``,
+                ``bytearray``, ``memoryview``, ``mmap``).  Buffers are not
+                copied as a whole, they are encoded chunk by chunk.
+            :param chunk_size: number of bytes processed at once, rounded
+                down to a multiple of the block size.
+        """
+        block_size = self.block_size
+        chunk_size = max(chunk_size // block_size, 1) * block_size
+        tail = b''
+        for chunk in _iter_chunks(stream, chunk_size):
+            if tail:
+                chunk = tail + chunk
+            size = len(chunk) - len(chunk) % block_size
+            if size:
+                yield self._encode_blocks(chunk[:size])
+            tail = chunk[size:]
+            if isinstance(tail, memoryview):
+                tail = tail.tobytes()
+        if tail:
+            yield self._encode_block(tail)
+
+    def decode_stream(self, stream, chunk_size=CHUNK_SIZE):
+        """ Generator which yields decoded bytes of the *stream*.
+
+            :param stream: file-like object opened in text mode or a
+                string.
+            :param chunk_size: number of characters processed at once,
+                rounded down to a multiple of the encoded block width.
+
+            :raise ValueError: when the *stream* contains invalid data
+        """
+        block_width = self.block_width
+        chunk_size = max(chunk_size // block_width, 1) * block_width
+        tail = ''
+        for chunk in _iter_chunks(stream, chunk_size):
+            if tail:
+                chunk = tail + chunk
+            size = len(chunk) - len(chunk) % block_width
+            if size:
+                yield self._decode_blocks(chunk[:size])
+            tail = chunk[size:]
+        if tail:
+            yield self._decode_block(tail)
+
+    def _encode_block(self, block):
+        value = int(binascii.hexlify(block), 16)
+        return self.conv.int2str(value).rjust(
+            self.widths[len(block)], self.conv.digits[0])
+
+    def _decode_block(self, text):
+        size = self.sizes.get(len(text))
+        if not size:
+            raise ValueError('invalid encoded block length: %d' % len(text))
+        value = self.conv.str2int(text)
+        if value >> (size * 8):
+            raise ValueError("invalid encoded block: '%s'" % text)
+        return binascii.unhexlify('%0*x' % (size * 2, value))
+
+    def _encode_blocks(self, data):
+        block_size = self.block_size
+        numpy = _get_numpy()
+        if numpy is not None and block_size <= 8:
+            # convert all blocks to 64-bit integers and encode them at once
+            if isinstance(data, memoryview):
+                data = data.tobytes()
+            blocks = numpy.frombuffer(data, dtype=numpy.uint8).reshape(
+                -1, block_size)
+            values = numpy.zeros((len(blocks), 8), dtype=numpy.uint8)
+            values[:, 8 - block_size:] = blocks
+            return ''.join(self.conv.int2str_many(
+                values.view('>u8').ravel(), width=self.block_width))
+        encode_block = self._encode_block
+        return ''.join([encode_block(data[i:i + block_size])
+            for i in range(0, len(data), block_size)])
+
+    def _decode_blocks(self, text):
+        block_size, block_width = self.block_size, self.block_width
+        numpy = _get_numpy()
+        if numpy is not None and block_size <= 8 and isinstance(text, str):
+            values = self.conv.str2int_many(numpy.frombuffer(
+                text, dtype='S%d' % block_width))
+            if max(values) >> (block_size * 8):
+                raise ValueError('invalid encoded block')
+            blocks = numpy.array(values, dtype=numpy.uint64).astype('>u8')
+            blocks = blocks.view(numpy.uint8).reshape(-1, 8)
+            return blocks[:, 8 - block_size:].tobytes()
+        decode_block = self._decode_block
+        return b''.join([decode_block(text[i:i + block_width])
+            for i in range(0, len(text), block_width)])
+
+
+def _iter_chunks(stream, chunk_size):
+    read = getattr(stream, 'read', None)
+    if read is None:
+        if isinstance(stream, basestring):
+            data = stream
+        else:
+            data = memoryview(stream)
+        for i in range(0, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+        return
+    while True:
+        chunk = read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def encode(data, alphabet=BASE62, block_size=None):
+    """ Helper to encode bytes with :class:`BlockCodec`. """
+    return BlockCodec(alphabet, block_size).encode(data)
+
+
+def decode(text, alphabet=BASE62, block_size=None):
+    """ Helper to decode strings encoded with :class:`BlockCodec`. """
+    return BlockCodec(alphabet, block_size).decode(text)
+
+
+def encode_stream(stream, alphabet=BASE62, block_size=None,
+        chunk_size=CHUNK_SIZE):
+    """ Helper to encode a stream with :class:`BlockCodec`. """
+    return BlockCodec(alphabet, block_size).encode_stream(stream, chunk_size)
+
+
+def decode_stream(stream, alphabet=BASE62, block_size=None,
+        chunk_size=CHUNK_SIZE):
+    """ Helper to decode a stream with :class:`BlockCodec`. """
+    return BlockCodec(alphabet, block_size).decode_stream(stream, chunk_size)
@@ -0,0 +1,137 @@
+""" Bloom filter for integer values with optional memory-mapped storage.
+
+    A Bloom filter answers "definitely not present" or "probably present"
+    using a fixed amount of memory, about 1.2 bytes per value for 1% false
+    positives.  Values can be added, but never removed.
+
+    Usage::
+
+        from mcutils.bloom import BloomFilter
+
+        taken = BloomFilter(capacity=10 ** 6, error_rate=0.001)
+        taken.update(Entry.objects.values_list('uid', flat=True).iterator())
+        taken.save('/var/cache/app/entry-uid.bloom')
+
+        # in another process
+        taken = BloomFilter.load('/var/cache/app/entry-uid.bloom')
+        if uid not in taken:
+            pass  # no need to ask the database
+"""
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+
+__all__ = ['BloomFilter']
+
+
+_MAGIC = b'MCBLOOM1'
+_HEADER = struct.Struct('<8sQQQ')
+_MASK = 2 ** 64 - 1
+
+
+def _mix(x):
+    """ splitmix64 finalizer, spreads bits of 64-bit integer. """
+    x = ((x ^ (x >> 30)) * 0xbf58476d1ce4e5b9) & _MASK
+    x = ((x ^ (x >> 27)) * 0x94d049bb133111eb) & _MASK
+    return x ^ (x >> 31)
+
+
+class BloomFilter(object):
+    """ Bloom filter for integers.
+
+        :param capacity: expected number of values.
+        :param error_rate: probability of false positives when the filter
+            holds *capacity* values.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(int(capacity), 1)
+        num_bits = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(int(round(num_bits * math.log(2) / capacity)), 1)
+        self._init(num_bits, num_hashes, 0,
+                   bytearray(_HEADER.size + (num_bits + 7) // 8))
+        self.capacity = capacity
+
+    def _init(self, num_bits, num_hashes, count, bits):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.count = count
+        self.capacity = int(num_bits * math.log(2) / num_hashes)
+        self._bits = bits
+        self._lock = threading.Lock()
+
+    def _positions(self, value):
+        h1 = _mix((value ^ (value >> 64)) & _MASK)
+        h2 = _mix(h1 ^ 0x9e3779b97f4a7c15) | 1
+        num_bits = self.num_bits
+        return [(h1 + i * h2) % num_bits for i in range(self.num_hashes)]
+
+    def add(self, value):
+        """ Adds integer *value* to the filter. """
+        bits, offset = self._bits, _HEADER.size
+        with self._lock:
+            for position in self._positions(value):
+                index = offset + (position >> 3)
+                byte = struct.unpack_from('B', bits, index)[0]
+                struct.pack_into('B', bits, index,
+                                 byte | (1 << (position & 7)))
+            self.count += 1
+
+    def update(self, values):
+        """ Adds all integers of the *values* iterable to the filter. """
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value):
+        bits, offset = self._bits, _HEADER.size
+        for position in self._positions(value):
+            byte = struct.unpack_from('B', bits, offset + (position >> 3))[0]
+            if not byte & (1 << (position & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """ Returns number of values added (including duplicates). """
+        return self.count
+
+    def save(self, path):
+        """ Writes the filter to the file, atomically replacing it. """
+        with self._lock:
+            _HEADER.pack_into(self._bits, 0, _MAGIC, self.num_bits,
+                              self.num_hashes, self.count)
+            data = self._bits[:]
+        fd, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)))
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        """ Maps the file written by :meth:`save` into memory.
+
+            The file is mapped copy-on-write: pages are shared between
+            processes which load the same file, values added afterwards
+            stay private to the process.
+
+            :raise ValueError: when the file is not a saved filter
+        """
+        with open(path, 'rb') as f:
+            bits = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        if len(bits) < _HEADER.size:
+            raise ValueError('%s is not a bloom filter file' % path)
+        magic, num_bits, num_hashes, count = _HEADER.unpack_from(bits, 0)
+        if magic != _MAGIC or len(bits) < (
+                _HEADER.size + (num_bits + 7) // 8):
+            raise ValueError('%s is not a bloom filter file' % path)
+        self = cls.__new__(cls)
+        self._init(num_bits, num_hashes, count, bits)
+        return self
@@ -1,8 +1,76 @@
+import collections
 import functools
+import hashlib
 import inspect
+import io
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import types
+import zlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
+
+from mcutils import _ProcessLocal
+
+
+# number of threads refreshing stale cached_property values, and maximum
+# number of refreshes waiting for them (more are skipped until next access)
+REFRESH_WORKERS = 4
+REFRESH_QUEUE_SIZE = 100
+
+
+logger = logging.getLogger(__name__)
+
+
+class _RefreshPool(_ProcessLocal):
+    """ Bounded pool of daemon threads, started on first use (and again
+    in a forked child process).
+    """
+
+    def __init__(self, workers=REFRESH_WORKERS, queue_size=REFRESH_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+
+    def _reset(self):
+        self._queue = queue.Queue(self.queue_size)
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        tasks = self._queue
+        while True:
+            func = tasks.get()
+            try:
+                func()
+            except Exception:
+                logger.exception('background refresh failed')
+
+    def submit(self, func):
+        """ Schedules *func* call, returns False if the queue is full. """
+        self._check_pid()
+        try:
+            self._queue.put_nowait(func)
+        except queue.Full:
+            return False
+        return True
+
 
+_refresh_pool = _RefreshPool()
 
-class cached_property(object):
+
+class cached_property(_ProcessLocal):
     """ Decorator for read-only properties evaluated only once within TTL
     period.
 
@@ -30,14 +98,34 @@ class cached_property(object):
     The default time-to-live (TTL) is 300 seconds (5 minutes). Set the TTL to
     zero for the cached value to never expire.
 
+    With `stale_while_revalidate=True` an expired value is returned at once
+    and recomputed in background by one of `REFRESH_WORKERS` shared threads,
+    at most once at a time for the same property of the same object. Values
+    older than TTL plus `max_stale` seconds (if given) are recomputed by the
+    caller as usual::
+
+            @cached_property(ttl=60, stale_while_revalidate=True,
+                             max_stale=600)
+            def quota(self):
+                return remote_api.get_quota(self.account_id)
+
     To expire a cached property value manually just do::
 
         del instance._cache[<property name>]
 
     (c) 2011 Christopher Arndt, MIT License
     """
-    def __init__(self, ttl=300):
+    def __init__(self, ttl=300, stale_while_revalidate=False,
+            max_stale=None):
         self.ttl = ttl
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_stale = max_stale
+        self._check_pid()
+
+    def _reset(self):
+        # refreshes of the parent process don't run in a forked child
+        self._refreshing = set()
+        self._lock = threading.Lock()
 
     def __call__(self, fget, doc=None):
         self.fget = fget
@@ -47,11 +135,15 @@ class cached_property(object):
         return self
 
     def __get__(self, inst, owner):
-        import time
         now = time.time()
         try:
             value, last_update = inst._cache[self.__name__]
             if self.ttl > 0 and now - last_update > self.ttl:
+                if (self.stale_while_revalidate and (
+                        self.max_stale is None or
+                        now - last_update <= self.ttl + self.max_stale)):
+                    self._refresh(inst)
+                    return value
                 raise AttributeError
         except (KeyError, AttributeError):
             value = self.fget(inst)
@@ -62,6 +154,26 @@ class cached_property(object):
             cache[self.__name__] = (value, now)
         return value
 
+    def _refresh(self, inst):
+        self._check_pid()
+        key = id(inst)
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                start = time.time()
+                inst._cache[self.__name__] = (self.fget(inst), start)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        if not _refresh_pool.submit(refresh):
+            with self._lock:
+                self._refreshing.discard(key)
+
 
 def naive_memoize(function):
     "Standard memoization decorator."
@@ -181,6 +293,166 @@ def deprecated(func):
     return new_func
 
 
+CacheInfo = collections.namedtuple('CacheInfo',
+    ['hits', 'misses', 'maxsize', 'currsize'])
+
+# eviction policies of bounded memoize caches: least recently used or least
+# frequently used values are dropped first
+LRU = 'lru'
+LFU = 'lfu'
+
+# shared_memoize compresses serialized values longer than this
+SHARED_MEMOIZE_COMPRESS_MIN = 1024
+
+# default maximum number of values of a function kept in memoize file, and
+# number of insertions between checks of the limit
+PERSISTENT_MEMOIZE_SIZE = 10000
+PERSISTENT_MEMOIZE_EVICT_EVERY = 64
+
+_missing = object()
+_kwargs_mark = object()
+
+# separates keyword arguments in keys of values kept out of the process
+_KWARGS_MARK = '__kwargs__'
+
+
+def _make_key(args, kwargs):
+    key = args
+    if kwargs:
+        key += (_kwargs_mark, ) + tuple(sorted(kwargs.items()))
+    return key
+
+
+def _canonical(value):
+    if isinstance(value, tuple):
+        return tuple(_canonical(item) for item in value)
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    if isinstance(value, dict):
+        return ('dict', sorted((_canonical(key), _canonical(item))
+            for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return ('set', sorted(_canonical(item) for item in value))
+    meta = getattr(value, '_meta', None)
+    if meta is not None and hasattr(value, 'pk'):
+        if value.pk is None:
+            raise TypeError('cannot make key of unsaved %r' % (value, ))
+        return ('model', '%s.%s' % (meta.app_label, meta.object_name),
+            value.pk)
+    return value
+
+
+def _canonical_key(args, kwargs):
+    """ Returns digest of the arguments which is the same in all processes.
+    Model instances are represented by their model and primary key, other
+    values are pickled.  Raises TypeError if the arguments can't be pickled.
+    """
+    key = (_canonical(args), )
+    if kwargs:
+        key += (_KWARGS_MARK, sorted((name, _canonical(value))
+            for name, value in kwargs.items()))
+    data = io.BytesIO()
+    pickler = pickle.Pickler(data, 2)
+    # without memo equal arguments are pickled the same way whether or not
+    # they are the same object
+    pickler.fast = True
+    try:
+        pickler.dump(key)
+    except (pickle.PicklingError, TypeError, ValueError, AttributeError,
+            RuntimeError) as e:
+        raise TypeError('cannot make key of arguments: %s' % (e, ))
+    return hashlib.md5(data.getvalue()).hexdigest()
+
+
+class _LRUCache(object):
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+
+    def get(self, key):
+        entry = self.data.pop(key, _missing)
+        if entry is not _missing:
+            self.data[key] = entry
+        return entry
+
+    def set(self, key, entry):
+        self.data.pop(key, None)
+        self.data[key] = entry
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def clear(self):
+        self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+class _LFUCache(object):
+    """ O(1) LFU: keys are grouped by the number of uses, the least recently
+    used key of the least used group is dropped first.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.clear()
+
+    def _touch(self, key, item):
+        count = item[1]
+        group = self.groups[count]
+        del group[key]
+        if not group:
+            del self.groups[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+        item[1] = count + 1
+        self.groups[count + 1][key] = None
+
+    def get(self, key):
+        item = self.data.get(key)
+        if item is None:
+            return _missing
+        self._touch(key, item)
+        return item[0]
+
+    def set(self, key, entry):
+        item = self.data.get(key)
+        if item is not None:
+            item[0] = entry
+            self._touch(key, item)
+            return
+        if len(self.data) >= self.maxsize:
+            if self.min_count not in self.groups:
+                self.min_count = min(self.groups)
+            group = self.groups[self.min_count]
+            old_key = group.popitem(last=False)[0]
+            if not group:
+                del self.groups[self.min_count]
+            del self.data[old_key]
+        self.data[key] = [entry, 1]
+        self.groups[1][key] = None
+        self.min_count = 1
+
+    def delete(self, key):
+        item = self.data.pop(key, None)
+        if item is not None:
+            group = self.groups[item[1]]
+            del group[key]
+            if not group:
+                del self.groups[item[1]]
+
+    def clear(self):
+        self.data = {}
+        self.groups = collections.defaultdict(collections.OrderedDict)
+        self.min_count = 0
+
+    def __len__(self):
+        return len(self.data)
+
+
 class memoize(object):
     """ Decorator to cache a function's return value each time it is called.
     If called later with the same arguments, the cached value is returned, and
@@ -193,23 +465,150 @@ class memoize(object):
             if n in (0, 1):
                return n
             return fibonacci(n-1) + fibonacci(n-2)
+
+    By default values are kept forever. Pass `maxsize` to keep at most that
+    many values, dropping least recently used ones (or least frequently used
+    ones with `policy=LFU`), and `ttl` to recompute values older than `ttl`
+    seconds. The lock of a bounded cache is not held while the function is
+    computed, so threads calling it wait for each other only to look up and
+    store values. `maxsize=0` disables caching::
+
+         @memoize(maxsize=1000, ttl=60)
+         def get_rate(currency, date=None):
+            ...
+
+         get_rate.cache_info()  # CacheInfo(hits=..., misses=..., ...)
+         get_rate.cache_clear()
+
+    Keyword arguments are part of the key regardless of their order.
+    Uncachable arguments (e.g. lists) are passed to the function without
+    caching.
+
+    Values may also be kept in SQLite file at `path`, so they survive
+    restarts and are shared by processes on the same host. Keys are made of
+    the pickled arguments (see :class:`shared_memoize`), calls with
+    arguments which can't be pickled are not kept in the file. The file
+    keeps at most `path_maxsize` values of the function, oldest ones are
+    dropped first. Values stored by a different version of the function
+    source code are discarded::
+
+         @memoize(path='/var/cache/app/memoize.sqlite')
+         def load_translit_table(lang):
+            ...
     """
 
-    def __init__(self, func):
+    def __init__(self, func=None, maxsize=None, ttl=None, policy=LRU,
+            path=None, path_maxsize=PERSISTENT_MEMOIZE_SIZE):
+        if policy not in (LRU, LFU):
+            raise ValueError('unknown policy: %r' % (policy, ))
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.policy = policy
+        self.path = path
+        self.path_maxsize = path_maxsize
+        self._store = None
+        self.func = None
+        self.hits = self.misses = 0
+        self._lock = threading.Lock()
+        if maxsize is None and ttl is None:
+            self.cache = {}
+            self._bounded = None
+        else:
+            cache_class = _LFUCache if policy == LFU else _LRUCache
+            if maxsize is None:
+                maxsize = float('inf')
+            self._bounded = cache_class(maxsize)
+            self.cache = None
+        if func is not None:
+            self._wrap(func)
+
+    def _wrap(self, func):
         self.func = func
-        self.cache = {}
+        functools.update_wrapper(self, func, updated=())
+        if self.path:
+            self._store = _SQLiteStore(self.path, func, self.path_maxsize)
+
+    def _compute(self, args, kwargs):
+        store = self._store
+        if store is not None:
+            try:
+                key = _canonical_key(args, kwargs)
+            except TypeError:
+                # the arguments can't be kept in the file
+                store = None
+        if store is not None:
+            value = store.get(key)
+            if value is not _missing:
+                return value
+        value = self.func(*args, **kwargs)
+        if store is not None:
+            store.set(key, value, self.ttl)
+        return value
 
-    def __call__(self, *args):
+    def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # used as @memoize(...)
+            self._wrap(args[0])
+            return self
+        key = _make_key(args, kwargs)
         try:
-            return self.cache[args]
-        except KeyError:
-            value = self.func(*args)
-            self.cache[args] = value
-            return value
+            hash(key)
         except TypeError:
             # uncachable -- for instance, passing a list as an argument.
             # Better to not cache than to blow up entirely.
-            return self.func(*args)
+            return self.func(*args, **kwargs)
+
+        if self.maxsize == 0:
+            self.misses += 1
+            return self._compute(args, kwargs)
+
+        if self._bounded is None:
+            value = self.cache.get(key, _missing)
+            if value is not _missing:
+                self.hits += 1
+                return value
+            self.misses += 1
+            value = self.cache[key] = self._compute(args, kwargs)
+            return value
+
+        cache = self._bounded
+        with self._lock:
+            entry = cache.get(key)
+            if entry is not _missing:
+                value, expires = entry
+                if expires is None or expires > time.time():
+                    self.hits += 1
+                    return value
+                cache.delete(key)
+            self.misses += 1
+        value = self._compute(args, kwargs)
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            cache.set(key, (value, expires))
+        return value
+
+    def cache_info(self):
+        """ Returns named tuple of hits, misses, maximum and current size of
+        the cache.
+        """
+        if self._bounded is None:
+            currsize = len(self.cache)
+        else:
+            currsize = len(self._bounded)
+        return CacheInfo(self.hits, self.misses, self.maxsize, currsize)
+
+    def cache_clear(self):
+        """ Drops all cached values and statistics. """
+        if self._bounded is None:
+            self.cache.clear()
+        else:
+            with self._lock:
+                self._bounded.clear()
+        if self._store is not None:
+            self._store.clear()
+        self.hits = self.misses = 0
 
     def __repr__(self):
         """ Return the function's docstring. """
@@ -217,4 +616,286 @@ class memoize(object):
 
     def __get__(self, obj, objtype):
         """ Support instance methods. """
-        return functools.partial(self.__call__, obj)
+        if obj is None:
+            return self
+        return types.MethodType(self, obj)
+
+
+def _dumps(value):
+    data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    if len(data) > SHARED_MEMOIZE_COMPRESS_MIN:
+        return b'z' + zlib.compress(data)
+    return b'p' + data
+
+
+def _loads(data):
+    if data[:1] == b'z':
+        return pickle.loads(zlib.decompress(data[1:]))
+    return pickle.loads(data[1:])
+
+
+class _SQLiteStore(object):
+    """ Values of one function kept in SQLite database.
+
+        The database is opened in WAL mode, so processes read it while
+        another one writes.  Errors of the database are logged and
+        treated as misses.
+    """
+
+    def __init__(self, path, func, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.name = '%s.%s' % (func.__module__,
+            getattr(func, '__qualname__', func.__name__))
+        try:
+            source = inspect.getsource(func)
+        except (IOError, TypeError):
+            source = getattr(func, '__code__', func).co_code
+        self.version = hashlib.sha1(source).hexdigest()
+        self._local = threading.local()
+
+    def _connect(self):
+        local = self._local
+        if getattr(local, 'pid', None) == os.getpid():
+            return local.connection
+        connection = sqlite3.connect(self.path, timeout=10,
+            isolation_level=None, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute(
+            'CREATE TABLE IF NOT EXISTS memoize (name TEXT, key TEXT, '
+            'version TEXT, expires REAL, value BLOB, '
+            'PRIMARY KEY (name, key))')
+        # drop values of the previous versions of the function
+        connection.execute(
+            'DELETE FROM memoize WHERE name = ? AND version != ?',
+            (self.name, self.version))
+        local.connection, local.pid = connection, os.getpid()
+        return connection
+
+    def get(self, key):
+        try:
+            row = self._connect().execute(
+                'SELECT value, expires FROM memoize '
+                'WHERE name = ? AND key = ? AND version = ?',
+                (self.name, key, self.version)).fetchone()
+        except sqlite3.Error:
+            logger.exception('memoize file read failed: %s', self.path)
+            return _missing
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return _missing
+        try:
+            return _loads(bytes(row[0]))
+        except Exception:
+            # e.g. the class of the value was renamed since it was stored
+            logger.exception('memoize file value unreadable: %s', self.path)
+            self.delete(key)
+            return _missing
+
+    def set(self, key, value, ttl=None):
+        expires = None
+        if ttl is not None:
+            expires = time.time() + ttl
+        try:
+            connection = self._connect()
+            cursor = connection.execute(
+                'INSERT OR REPLACE INTO memoize VALUES (?, ?, ?, ?, ?)',
+                (self.name, key, self.version, expires,
+                 sqlite3.Binary(_dumps(value))))
+            if not cursor.lastrowid % PERSISTENT_MEMOIZE_EVICT_EVERY:
+                connection.execute(
+                    'DELETE FROM memoize WHERE name = ? AND rowid <= ('
+                    'SELECT rowid FROM memoize WHERE name = ? '
+                    'ORDER BY rowid DESC LIMIT 1 OFFSET ?)',
+                    (self.name, self.name, self.maxsize))
+        except sqlite3.Error:
+            logger.exception('memoize file write failed: %s', self.path)
+
+    def delete(self, key):
+        try:
+            self._connect().execute(
+                'DELETE FROM memoize WHERE name = ? AND key = ?',
+                (self.name, key))
+        except sqlite3.Error:
+            logger.exception('memoize file write failed: %s', self.path)
+
+    def clear(self):
+        try:
+            self._connect().execute(
+                'DELETE FROM memoize WHERE name = ?', (self.name, ))
+        except sqlite3.Error:
+            logger.exception('memoize file write failed: %s', self.path)
+
+
+class shared_memoize(object):
+    """ Same as :class:`memoize`, but keeps values in a Django cache, so
+    they are shared by all processes using it.
+
+    Keys are made of the qualified name of the function and hash of its
+    pickled arguments, model instances are represented by their model and
+    primary key.  Arguments which can't be pickled raise TypeError (this
+    includes `self` of methods of such objects).  Values are pickled
+    and compressed when large.  Keys depend on cache generations (see
+    :mod:`mcutils.django.cache`): all values of the function become stale
+    after :meth:`invalidate` or after invalidation of any of the `models`
+    or `tags`.  Optional in-process cache of `local_maxsize` values, kept
+    for `local_ttl` seconds, saves requests to the shared cache for hot
+    values.
+
+    Usage::
+
+         @shared_memoize(ttl=3600, models=[Product], local_maxsize=100)
+         def get_price_list(category_id):
+            ...
+
+         get_price_list.invalidate()
+    """
+
+    def __init__(self, func=None, ttl=None, alias=None, models=(), tags=(),
+            local_maxsize=None, local_ttl=5):
+        self.ttl = ttl
+        self.alias = alias
+        self.models = tuple(models)
+        self.tags = tuple(tags)
+        self.local_ttl = local_ttl
+        self._local = None
+        if local_maxsize:
+            self._local = _LRUCache(local_maxsize)
+            self._local_lock = threading.Lock()
+        self.func = None
+        if func is not None:
+            self._wrap(func)
+
+    def _wrap(self, func):
+        self.func = func
+        functools.update_wrapper(self, func, updated=())
+        self.name = '%s.%s' % (func.__module__,
+            getattr(func, '__qualname__', func.__name__))
+
+    def make_key(self, *args, **kwargs):
+        """ Returns cache key of the call with given arguments. """
+        from mcutils.django.cache import make_cache_key
+        digest = _canonical_key(args, kwargs)
+        return make_cache_key('%s:%s' % (self.name, digest),
+            models=self.models, tags=(self.name, ) + self.tags)
+
+    def __call__(self, *args, **kwargs):
+        if self.func is None:
+            # used as @shared_memoize(...)
+            self._wrap(args[0])
+            return self
+        from mcutils.django.cache import get_cache
+        cache_key = self.make_key(*args, **kwargs)
+        if self._local is not None:
+            with self._local_lock:
+                entry = self._local.get(cache_key)
+            if entry is not _missing and entry[1] > time.time():
+                return entry[0]
+        backend = get_cache(self.alias)
+        data = backend.get(cache_key)
+        if data is not None:
+            value = _loads(data)
+        else:
+            value = self.func(*args, **kwargs)
+            if self.ttl is None:
+                backend.set(cache_key, _dumps(value))
+            else:
+                backend.set(cache_key, _dumps(value), self.ttl)
+        if self._local is not None:
+            with self._local_lock:
+                self._local.set(cache_key, (value, time.time() +
+                    self.local_ttl))
+        return value
+
+    def invalidate(self):
+        """ Makes all values of the function stale in all processes. """
+        from mcutils.django.cache import invalidate_tag_cache
+        invalidate_tag_cache(self.name)
+
+    def __get__(self, obj, objtype):
+        """ Support instance methods. """
+        if obj is None:
+            return self
+        return types.MethodType(self, obj)
+
+
+class _Call(object):
+    """ Result of the call shared by concurrent callers. """
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+def single_flight(func):
+    """ Decorator to make concurrent calls with equal arguments share one
+    call of the function: the first caller calls it, the others wait for
+    its result (or its exception).  Coroutine functions are supported as
+    well, calls made from coroutines of the same event loop share a single
+    task.
+
+    Combined with :class:`memoize` or :class:`shared_memoize` it makes
+    concurrent cache misses compute the value once::
+
+         @memoize(maxsize=100, ttl=60)
+         @single_flight
+         def get_report(day):
+            ...
+
+    Uncachable arguments (e.g. lists) are passed to the function without
+    sharing the call.
+    """
+    if asyncio is not None and asyncio.iscoroutinefunction(func):
+        return _async_single_flight(func)
+    calls = {}
+    lock = threading.Lock()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = _make_key(args, kwargs)
+        try:
+            with lock:
+                call = calls.get(key)
+                leader = call is None
+                if leader:
+                    call = calls[key] = _Call()
+        except TypeError:
+            return func(*args, **kwargs)
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value
+        try:
+            call.value = func(*args, **kwargs)
+            return call.value
+        except BaseException as e:
+            # followers must not take None for the result when the call
+            # was interrupted (e.g. by SystemExit or GreenletExit)
+            call.error = e
+            raise
+        finally:
+            with lock:
+                del calls[key]
+            call.event.set()
+
+    return wrapper
+
+
+def _async_single_flight(func):
+    calls = {}
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (asyncio.get_event_loop(), _make_key(args, kwargs))
+        try:
+            task = calls.get(key)
+        except TypeError:
+            return asyncio.ensure_future(func(*args, **kwargs))
+        if task is None:
+            task = calls[key] = asyncio.ensure_future(func(*args, **kwargs))
+            task.add_done_callback(lambda task: calls.pop(key, None))
+        # cancellation of one caller must not cancel the others
+        return asyncio.shield(task)
+
+    return wrapper
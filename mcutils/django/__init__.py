@@ -1,4 +1,9 @@
 import datetime
+import functools
+import operator
+import os
+import threading
+import time
 
 import django
 from django import db
@@ -6,33 +11,74 @@ from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from django.shortcuts import _get_queryset
 from django.utils import six
-from django.utils.text import slugify
 try:
     from django.utils import timezone
 except ImportError:
     timezone = None
-from unidecode import unidecode
 
-from .. import random_in_range
+from .. import _ProcessLocal, entropy_pool, random_in_range_many
+from ..text import slugify
 
 
 __all__ = [
     'create_slug',
+    'create_slugs',
     'get_object_or_none',
     'get_object_dto',
     'make_model_dto',
     'model_uid_generator',
     'reverse_lazy',
+    'snowflake_uid_generator',
     'timestamp_with_timezone',
+    'UidOccupancyIndex',
     'update_object_from_dto',
 ]
 
 
-def create_slug(value, model_class=None, field_name=None, queryset=None,
-        separator='-', max_length=None, exclude=None):
+# maximum number of slugs or prefixes looked up by one create_slugs query
+SLUG_QUERY_CHUNK_SIZE = 200
+
+# number of random candidates drawn at once by model_uid_generator
+UID_BATCH_SIZE = 16
+
+# number of pre-validated IDs kept by model_uid_generator
+UID_RESERVOIR_SIZE = 32
+
+# number of seconds snowflake node identifier of the process is leased for,
+# the lease is renewed when a third of it is left
+UID_NODE_LEASE_TTL = 3600
+
+
+def _slug_base(slug, width, separator, max_length):
+    """ Returns *slug* truncated to leave room for a separator and a
+    *width* digits long index.
     """
-    This function is mostly based on django snippet #690 (http://goo.gl/RYV5x3)
+    end_length = len(separator) + width
+    if max_length and len(slug) + end_length > max_length:
+        slug = slug[:max_length - end_length]
+        slug = slug.strip(separator)
+    return slug
+
+
+def _slug_indexes(width):
+    """ Returns suffix indexes *width* digits long. """
+    return range(max(2, 10 ** (width - 1)), 10 ** width)
+
+
+def _get_taken_slugs(queryset, field_name, prefix, width):
+    """ Returns set of taken slugs among *prefix* followed by *width* digits
+    long indexes, looked up by the exact values for short indexes.
     """
+    indexes = _slug_indexes(width)
+    if len(indexes) <= SLUG_QUERY_CHUNK_SIZE:
+        lookup = {'%s__in' % field_name: [
+            '%s%s' % (prefix, index) for index in indexes]}
+    else:
+        lookup = {'%s__startswith' % field_name: prefix}
+    return set(queryset.filter(**lookup).values_list(field_name, flat=True))
+
+
+def _get_slug_model(model_class):
     if isinstance(model_class, six.string_types):
         def __dummy():
             pass
@@ -44,8 +90,23 @@ def create_slug(value, model_class=None, field_name=None, queryset=None,
             model_name = model_class
         from django.db import models
         model_class = models.get_model(app_label, model_name)
+    return model_class
 
-    slug = slugify(six.text_type(unidecode(value)))
+
+def _make_slug(value, separator, max_length):
+    slug = slugify(value)
+    if max_length:
+        slug = slug[:max_length]
+        slug = slug.strip(separator)
+    return slug
+
+
+def _prepare_slug_args(model_class, field_name, queryset, max_length,
+        exclude):
+    """ Resolves model, slug field, queryset and max length the same way
+    for :func:`create_slug` and :func:`create_slugs`.
+    """
+    model_class = _get_slug_model(model_class)
 
     # calculate max length
     from django.db.models.base import ModelBase
@@ -55,36 +116,166 @@ def create_slug(value, model_class=None, field_name=None, queryset=None,
         slug_field = model_class._meta.get_field(field_name)
         max_length = slug_field.max_length
 
-    if max_length:
-        slug = slug[:max_length]
-        slug = slug.strip(separator)
-
     # make unique slug
     if queryset is None and isinstance(model_class, ModelBase):
         queryset = model_class._default_manager.all()
         if isinstance(exclude, dict):
             queryset = queryset.exclude(**exclude)
 
+    if field_name is None:
+        field_name = "slug"
+    return field_name, queryset, max_length
+
+
+def create_slug(value, model_class=None, field_name=None, queryset=None,
+        separator='-', max_length=None, exclude=None, stats=None):
+    """
+    This function is mostly based on django snippet #690 (http://goo.gl/RYV5x3)
+
+    If the slug is taken, its candidates with one digit suffixes are
+    looked up with a single query, then with two digit ones and so on
+    (from three digits on, all slugs starting with the slug and the
+    separator are fetched); the free suffix is found in memory.  If
+    `stats` dict is given, number of queries issued is stored in its
+    'queries' item.
+    """
+    field_name, queryset, max_length = _prepare_slug_args(
+        model_class, field_name, queryset, max_length, exclude)
+    slug = _make_slug(value, separator, max_length)
+
     # Find a unique slug. If one matches, add '-2' to the end and try again
     # (then '-3', etc).
     # TODO(sprymak): pass index generator function as an argument.
     # create_slug(name, index_generator = lambda x: x + random.randint(1, 9))
     # index = index_generator(index)
+    queries = 0
     if queryset is not None:
-        index = 2
-        original_slug = slug
-        while not slug or queryset.filter(**{field_name: slug}):
-            slug = original_slug
-            end = '%s%s' % (separator, index)
-            if max_length and len(slug) + len(end) > max_length:
-                slug = slug[:max_length - len(end)]
-                slug = slug.strip(separator)
-            slug = '%s%s' % (slug, end)
-            index += 1
+        taken = True
+        if slug:
+            taken = queryset.filter(**{field_name: slug}).exists()
+            queries += 1
+        width = 1
+        while taken:
+            prefix = _slug_base(slug, width, separator, max_length) + separator
+            taken_slugs = _get_taken_slugs(
+                queryset, field_name, prefix, width)
+            queries += 1
+            for index in _slug_indexes(width):
+                candidate = '%s%s' % (prefix, index)
+                if candidate not in taken_slugs:
+                    slug, taken = candidate, False
+                    break
+            else:
+                width += 1
 
+    if stats is not None:
+        stats['queries'] = queries
     return slug
 
 
+def create_slugs(values, model_class=None, field_name=None, queryset=None,
+        separator='-', max_length=None, exclude=None, stats=None):
+    """ Bulk version of :func:`create_slug`, returns list of slugs unique
+    among themselves and in the database, in order of `values`.
+
+    Every distinct value is transliterated once.  Existing slugs are
+    fetched with `__in` queries for the plain slugs and `startswith`
+    queries (the slug followed by the separator) for the ones which need
+    a suffix, at most `SLUG_QUERY_CHUNK_SIZE` slugs or prefixes per
+    query.  A plain slug is
+    preferred to suffixed ones, so results may differ from calling
+    :func:`create_slug` for every value in turn.
+
+    Usage::
+
+        slugs = create_slugs([row['title'] for row in rows], Product)
+        Product.objects.bulk_create([
+            Product(slug=slug, **row) for slug, row in zip(slugs, rows)])
+    """
+    field_name, queryset, max_length = _prepare_slug_args(
+        model_class, field_name, queryset, max_length, exclude)
+    cache = {}
+    slugs = []
+    for value in values:
+        if value not in cache:
+            cache[value] = _make_slug(value, separator, max_length)
+        slugs.append(cache[value])
+
+    queries = 0
+    existing = set()
+    if queryset is not None:
+        unique_slugs = list(set(slug for slug in slugs if slug))
+        for i in range(0, len(unique_slugs), SLUG_QUERY_CHUNK_SIZE):
+            existing.update(queryset.filter(**{
+                '%s__in' % field_name:
+                    unique_slugs[i:i + SLUG_QUERY_CHUNK_SIZE],
+            }).values_list(field_name, flat=True))
+            queries += 1
+
+    # plain slugs first, then suffixes for the rest
+    used = set()
+    pending = []
+    for i, slug in enumerate(slugs):
+        if slug and slug not in existing and slug not in used:
+            used.add(slug)
+        else:
+            pending.append(i)
+
+    width = 1
+    taken = {}
+    next_index = {}
+    while pending:
+        prefixes = {}
+        for i in pending:
+            slug = slugs[i]
+            if slug not in prefixes:
+                prefixes[slug] = _slug_base(
+                    slug, width, separator, max_length) + separator
+        if queryset is not None:
+            new_prefixes = list(set(prefix for prefix in prefixes.values()
+                if prefix not in taken))
+            for i in range(0, len(new_prefixes), SLUG_QUERY_CHUNK_SIZE):
+                chunk = new_prefixes[i:i + SLUG_QUERY_CHUNK_SIZE]
+                lookup = functools.reduce(operator.or_, [
+                    db.models.Q(**{'%s__startswith' % field_name: prefix})
+                    for prefix in chunk])
+                for prefix in chunk:
+                    taken[prefix] = set()
+                queries += 1
+                # candidates are prefixes followed by digits only, the
+                # separator ends every prefix, so stripping the digits
+                # gives the prefix of a candidate
+                for found_slug in queryset.filter(lookup).values_list(
+                        field_name, flat=True):
+                    prefix_taken = taken.get(found_slug.rstrip('0123456789'))
+                    if prefix_taken is not None:
+                        prefix_taken.add(found_slug)
+        no_slugs = set()
+        still_pending = []
+        indexes = _slug_indexes(width)
+        for i in pending:
+            slug = slugs[i]
+            prefix = prefixes[slug]
+            prefix_taken = taken.get(prefix, no_slugs)
+            for index in range(
+                    max(next_index.get(slug, 2), indexes[0]), 10 ** width):
+                candidate = '%s%s' % (prefix, index)
+                if candidate not in prefix_taken and candidate not in used:
+                    used.add(candidate)
+                    slugs[i] = candidate
+                    next_index[slug] = index + 1
+                    break
+            else:
+                next_index[slug] = 10 ** width
+                still_pending.append(i)
+        pending = still_pending
+        width += 1
+
+    if stats is not None:
+        stats['queries'] = queries
+    return slugs
+
+
 def get_max_uid_value(model_class, field_name):
     max_value = None
     max_config_values = getattr(settings, 'MAX_UID_VALUE', {})
@@ -103,7 +294,7 @@ def get_max_uid_value(model_class, field_name):
     return max_value
 
 
-class model_uid_generator(object):
+class model_uid_generator(_ProcessLocal):
     """
         Usage::
 
@@ -111,12 +302,35 @@ class model_uid_generator(object):
           uid = models.BigIntegerField(unique=True, editable=False,
               default=utils.model_uid_generator("blog.Entry", field_name="uid",
                   max_value=MAX_UID_VALUE))
+
+    Unique IDs are taken from a per-process reservoir of up to
+    `reservoir_size` pre-validated values.  When the reservoir drops to
+    `low_water_mark` values it is refilled with a block of random
+    candidates checked with a single ``field__in`` query.  Set
+    `reservoir_size` to 0 to check every candidate with its own query.
+
+    With ``optimistic=True`` random values are returned without any
+    uniqueness check, collisions are expected to be handled on insert
+    (see :class:`mcutils.django.fields.OptimisticUidMixin`).
+
+    With `occupancy_index` (a :class:`UidOccupancyIndex` of the same
+    model field) only candidates which are probably taken are checked
+    with the database.
     """
-    def __init__(self, model_class, max_value=None, min_value=None, field_name="pk"):
+    def __init__(self, model_class, max_value=None, min_value=None,
+            field_name="pk", batch_size=UID_BATCH_SIZE,
+            reservoir_size=UID_RESERVOIR_SIZE, low_water_mark=0,
+            optimistic=False, occupancy_index=None):
         self.model_class = model_class
+        self.optimistic = optimistic
+        self.occupancy_index = occupancy_index
         self.min_value = min_value
         self.max_value = max_value
         self.field_name = field_name
+        self.batch_size = batch_size
+        self.reservoir_size = reservoir_size
+        self.low_water_mark = low_water_mark
+        self._check_pid()
         if self.min_value is None:
             self.min_value = 0
         if self.max_value is None:
@@ -124,16 +338,37 @@ class model_uid_generator(object):
             if self.max_value is None:
                 raise ImproperlyConfigured()
 
-    def get_random_id(self):
-        """ Get random integer. """
-        return random_in_range(
-            min_value=self.min_value, max_value=self.max_value)
+    def _reset(self):
+        self._candidates = []
+        self._reservoir = []
+        self._reservoir_lock = threading.Lock()
 
-    def is_unique(self, value):
+    def get_random_id(self):
+        """ Get random integer.
+
+        Candidates are drawn in batches of `batch_size` values and handed
+        out one at a time.  A forked process never reuses candidates drawn
+        by its parent.
+        """
+        self._check_pid()
+        while True:
+            try:
+                return self._candidates.pop()
+            except IndexError:
+                self._candidates = random_in_range_many(self.batch_size,
+                    min_value=self.min_value, max_value=self.max_value)
+
+    def _can_query(self):
         # Assume generated value is unique if it is not a Django model
         # or ID field name is empty.
-        if not (self.field_name and self.model_class
-                and issubclass(self.model_class, db.models.Model)):
+        return bool(self.field_name and self.model_class
+            and issubclass(self.model_class, db.models.Model))
+
+    def is_unique(self, value):
+        if not self._can_query():
+            return True
+        if (self.occupancy_index is not None and
+                value not in self.occupancy_index):
             return True
         try:
             queryset = _get_queryset(self.model_class)
@@ -145,7 +380,52 @@ class model_uid_generator(object):
             pass
         return False
 
-    def __call__(self):
+    def get_existing(self, values):
+        """ Returns set of *values* already taken, using a single query. """
+        if not (values and self._can_query()):
+            return set()
+        if self.occupancy_index is not None:
+            values = [value for value in values
+                      if value in self.occupancy_index]
+            if not values:
+                return set()
+        queryset = _get_queryset(self.model_class)
+        try:
+            return set(queryset.filter(**{
+                '%s__in' % self.field_name: list(values),
+            }).values_list(self.field_name, flat=True))
+        except db.DatabaseError:
+            # catch "no such table" errors while south schema inspecting
+            return set()
+
+    def refill(self):
+        """ Tops the reservoir up to `reservoir_size` unique values. """
+        with self._reservoir_lock:
+            self._refill()
+
+    def _refill(self):
+        while len(self._reservoir) < self.reservoir_size:
+            candidates = set(random_in_range_many(
+                self.reservoir_size - len(self._reservoir),
+                min_value=self.min_value, max_value=self.max_value))
+            candidates.difference_update(self._reservoir)
+            candidates.difference_update(self.get_existing(candidates))
+            self._reservoir.extend(candidates)
+
+    def get_unique_id(self):
+        """ Get random integer not used by the model yet. """
+        if not self.reservoir_size:
+            val = self.get_random_id()
+            while not self.is_unique(val):
+                val = self.get_random_id()
+            return val
+        self._check_pid()
+        with self._reservoir_lock:
+            if len(self._reservoir) <= self.low_water_mark:
+                self._refill()
+            return self._reservoir.pop()
+
+    def _resolve_model_class(self):
         if self.model_class is not None and not isinstance(
                 self.model_class, (six.string_types, db.models.base.ModelBase)):
             raise TypeError("model_class must be either a string or "
@@ -173,10 +453,234 @@ class model_uid_generator(object):
             max_length = field.max_length
             # TODO: guess maximum allowed value based on field type
 
-        val = self.get_random_id()
-        while not self.is_unique(val):
-            val = self.get_random_id()
-        return val
+    def __call__(self):
+        if self.optimistic:
+            return self.get_random_id()
+        self._resolve_model_class()
+        return self.get_unique_id()
+
+
+class UidOccupancyIndex(object):
+    """ Bloom filter (see :mod:`mcutils.bloom`) of values taken by a model
+    field, used by :class:`model_uid_generator` to skip uniqueness queries
+    for values which are definitely not taken.
+
+    The filter is built on first use by streaming ``values_list`` of the
+    field and is kept up to date with ``post_save`` signals and by
+    :func:`~mcutils.django.fields.bulk_create_with_uids`.  Values inserted
+    in other ways which bypass ``post_save`` (``bulk_create``, raw SQL)
+    must be added with :meth:`add`, otherwise they are taken for free
+    values without a database check.  Deleted
+    values can not be removed from a Bloom filter, they are counted
+    instead and the filter is rebuilt when they make `rebuild_ratio` of
+    all values (or when the filter outgrows its capacity).
+
+    If `path` is given, the filter is saved to the file after it is built
+    and new processes map the file into memory instead of scanning the
+    table, unless the file is older than `max_age` seconds.  Note that a
+    saved filter misses values inserted after it was saved, and no filter
+    sees values inserted by other processes: keep the unique constraint
+    on the field (and use optimistic inserts) to handle such collisions.
+
+        Usage::
+
+        entry_uids = UidOccupancyIndex('blog.Entry', 'uid',
+            path='/var/cache/blog/entry-uid.bloom', max_age=3600)
+
+        class Entry(models.Model):
+          uid = models.BigIntegerField(unique=True, editable=False,
+              default=utils.model_uid_generator("blog.Entry",
+                  field_name="uid", occupancy_index=entry_uids))
+    """
+    def __init__(self, model_class, field_name='pk', error_rate=0.01,
+            capacity=None, path=None, max_age=None, rebuild_ratio=0.1):
+        self.model_class = model_class
+        self.field_name = field_name
+        self.error_rate = error_rate
+        self.capacity = capacity
+        self.path = path
+        self.max_age = max_age
+        self.rebuild_ratio = rebuild_ratio
+        self.filter = None
+        self.deleted = 0
+        self._lock = threading.Lock()
+        self._connected = False
+        self._loaded = False
+
+    def _get_model_class(self):
+        if isinstance(self.model_class, six.string_types):
+            app_label, model_name = self.model_class.split(".")
+            self.model_class = db.models.get_model(app_label, model_name)
+        return self.model_class
+
+    def build(self):
+        """ Builds the filter from values stored in the database. """
+        from ..bloom import BloomFilter
+        queryset = _get_queryset(self._get_model_class())
+        capacity = self.capacity or max(queryset.count() * 2, 1024)
+        bloom = BloomFilter(capacity, self.error_rate)
+        bloom.update(queryset.values_list(
+            self.field_name, flat=True).iterator())
+        if self.path:
+            bloom.save(self.path)
+        self.filter = bloom
+        self.deleted = 0
+        return bloom
+
+    def _load(self):
+        from ..bloom import BloomFilter
+        if not (self.path and os.path.exists(self.path)):
+            return None
+        if self.max_age and (
+                time.time() - os.path.getmtime(self.path) > self.max_age):
+            return None
+        try:
+            bloom = BloomFilter.load(self.path)
+        except (IOError, ValueError):
+            return None
+        if len(bloom) > bloom.capacity:
+            return None
+        return bloom
+
+    def _get_filter(self):
+        bloom = self.filter
+        if bloom is not None:
+            return bloom
+        with self._lock:
+            if self.filter is None:
+                self._connect()
+                # the saved file is only read once, filters dropped after
+                # deletes or overflow must be rebuilt (and saved again)
+                if not self._loaded:
+                    self._loaded = True
+                    bloom = self._load()
+                self.filter = bloom or self.build()
+                self.deleted = 0
+            return self.filter
+
+    def _connect(self):
+        if self._connected:
+            return
+        from django.db.models.signals import post_delete, post_save
+        model_class = self._get_model_class()
+        post_save.connect(self._post_save, sender=model_class, weak=False,
+                          dispatch_uid=('uid_occupancy', id(self)))
+        post_delete.connect(self._post_delete, sender=model_class,
+                            weak=False,
+                            dispatch_uid=('uid_occupancy', id(self)))
+        self._connected = True
+
+    def add(self, values):
+        """ Adds inserted *values* to the filter. """
+        bloom = self.filter
+        if bloom is not None:
+            bloom.update(values)
+            if len(bloom) > bloom.capacity:
+                self.filter = None
+
+    def _post_save(self, sender, instance, created=False, **kwargs):
+        if created:
+            self.add([getattr(instance, self.field_name)])
+
+    def _post_delete(self, sender, instance, **kwargs):
+        bloom = self.filter
+        if bloom is not None:
+            self.deleted += 1
+            if self.deleted > len(bloom) * self.rebuild_ratio:
+                self.filter = None
+
+    def __contains__(self, value):
+        return value in self._get_filter()
+
+
+class _NodeLease(object):
+    """ Snowflake node identifier of the process leased in the Django
+    cache, callable to be passed as `node_id` to
+    :class:`~mcutils.snowflake.SnowflakeGenerator`.
+    """
+
+    def __init__(self, node_bits, alias=None):
+        self.node_bits = node_bits
+        self.alias = alias
+        self.node_id = None
+        self.token = None
+        self.renew_at = 0
+
+    def _key(self, node_id):
+        return 'mcutils/snowflake_node/%d' % node_id
+
+    def __call__(self):
+        from .cache import get_cache
+        backend = get_cache(self.alias)
+        token = '%d:%d' % (os.getpid(), entropy_pool.getrandint(8))
+        size = 2 ** self.node_bits
+        start = entropy_pool.getrandint(2) % size
+        for i in range(size):
+            node_id = (start + i) % size
+            if backend.add(self._key(node_id), token, UID_NODE_LEASE_TTL):
+                self.node_id, self.token = node_id, token
+                self.renew_at = time.time() + UID_NODE_LEASE_TTL * 2 / 3
+                return node_id
+        raise RuntimeError('all %d snowflake node identifiers are taken' % (
+            size, ))
+
+    def renew(self):
+        """ Extends the lease, returns False if it is lost. """
+        if time.time() < self.renew_at:
+            return True
+        from .cache import get_cache
+        backend = get_cache(self.alias)
+        key = self._key(self.node_id)
+        if backend.get(key) != self.token:
+            return False
+        backend.set(key, self.token, UID_NODE_LEASE_TTL)
+        self.renew_at = time.time() + UID_NODE_LEASE_TTL * 2 / 3
+        return True
+
+
+_snowflake_generator = None
+_snowflake_lease = None
+_snowflake_lock = threading.Lock()
+
+
+def snowflake_uid_generator():
+    """ Get time-ordered unique integer, see :mod:`mcutils.snowflake`.
+
+    Every process leases its own node identifier in the cache named by
+    ``UID_NODE_CACHE_ALIAS`` setting (``CACHE_GENERATION_ALIAS`` if not
+    set, see :mod:`mcutils.django.cache`), which
+    must be shared by all processes inserting rows, e.g. memcached; with
+    process-local caches (locmem) identifiers may collide.  Leases are
+    renewed while the process generates identifiers.  ``UID_NODE_ID``
+    setting pins the node identifier instead, it must then be different
+    for every process, so it can not be used with workers forked from
+    one master (forked processes fail with RuntimeError).
+
+        Usage::
+
+        class Entry(models.Model):
+          uid = models.BigIntegerField(unique=True, editable=False,
+              default=utils.snowflake_uid_generator)
+    """
+    global _snowflake_generator, _snowflake_lease
+    if _snowflake_generator is None:
+        with _snowflake_lock:
+            if _snowflake_generator is None:
+                from ..snowflake import NODE_BITS, SnowflakeGenerator
+                node_id = getattr(settings, 'UID_NODE_ID', None)
+                if node_id is None:
+                    _snowflake_lease = node_id = _NodeLease(NODE_BITS,
+                        getattr(settings, 'UID_NODE_CACHE_ALIAS', None))
+                _snowflake_generator = SnowflakeGenerator(node_id)
+    generator, lease = _snowflake_generator, _snowflake_lease
+    value = generator()
+    if lease is not None and not lease.renew():
+        with _snowflake_lock:
+            # another thread may have leased a new node identifier already
+            if not lease.renew():
+                generator.reset()
+        value = generator()
+    return value
 
 
 def get_object_or_none(model_class, *args, **kwargs):
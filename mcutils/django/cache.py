@@ -1,28 +1,540 @@
-CACHE_KEY = getattr('settings', 'CACHE_MIDDLEWARE_KEY_PREFIX', '')
+""" Generation-based invalidation of cached values.
+
+    Keys made with :func:`make_cache_key` include the current cache
+    generation, so :func:`invalidate_cache` makes all of them stale at once
+    by incrementing the generation.  Keys may also depend on generations
+    of a user, models or arbitrary tags, which are invalidated separately
+    with :func:`invalidate_user_cache`, :func:`invalidate_model_cache` and
+    :func:`invalidate_tag_cache`.  Generations are kept in the cache
+    named by the ``CACHE_GENERATION_ALIAS`` setting and remembered in the
+    process for ``CACHE_GENERATION_TTL`` seconds, so most keys are made
+    without asking the cache server; the ones a key needs are fetched
+    with a single ``get_many``.  Add
+    :class:`~mcutils.django.middleware.CacheGenerationMiddleware` to
+    ``MIDDLEWARE_CLASSES`` to use the same generation during the whole
+    request.
+"""
+import collections
+import functools
+import hashlib
+import logging
+import math
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.core import cache
+from django.core.cache.backends import base as cache_base
+from django.core.exceptions import ImproperlyConfigured
+
+from mcutils.django.lock import MutexError, mutually_exclusive
+
+# default timeout of the backend (Django < 1.6 backends take None for it)
+DEFAULT_TIMEOUT = getattr(cache_base, 'DEFAULT_TIMEOUT', None)
+
+__all__ = [
+    'cache_get_many',
+    'cache_set_many',
+    'get_cache',
+    'get_generation',
+    'get_generations',
+    'get_or_compute',
+    'get_version',
+    'invalidate_cache',
+    'invalidate_model_cache',
+    'invalidate_tag_cache',
+    'invalidate_user_cache',
+    'make_cache_key',
+    'make_cache_keys',
+    'model_namespace',
+    'release_generation',
+    'snapshot_generation',
+    'tag_namespace',
+    'TwoTierCache',
+    'user_namespace',
+]
+
+
+CACHE_KEY = getattr(settings, 'CACHE_MIDDLEWARE_KEY_PREFIX', '')
 CACHE_GENERATION_KEY = CACHE_KEY + '/cache_gen'
 
+# alias of the cache which keeps the generation
+CACHE_GENERATION_ALIAS = getattr(settings, 'CACHE_GENERATION_ALIAS',
+    cache.DEFAULT_CACHE_ALIAS)
+
+# number of seconds the generation is remembered in the process, 0 to ask
+# the cache every time (but still once per request with the middleware)
+CACHE_GENERATION_TTL = getattr(settings, 'CACHE_GENERATION_TTL', 1)
+
+# hash function of cache keys: 'md5' or a faster 'blake2b' (needs Python
+# 3.6+ or pyblake2 package), changing it makes all keys stale
+CACHE_KEY_DIGEST = getattr(settings, 'CACHE_KEY_DIGEST', 'md5')
+
+# maximum number of generations remembered in the process
+CACHE_GENERATION_LOCAL_SIZE = 4096
+
+# default size and number of seconds values are kept by TwoTierCache in
+# the process
+LOCAL_CACHE_SIZE = 1024
+LOCAL_CACHE_TTL = 5
+
+
+logger = logging.getLogger(__name__)
+
+_caches = {}
+_generations = collections.OrderedDict()
+_generations_lock = threading.Lock()
+_local = threading.local()
+_missing = object()
+
+# number of seconds get_or_compute holds the lock at most, and waits for
+# the value computed by another process on miss
+COMPUTE_LOCK_TIMEOUT = 30
+COMPUTE_WAIT = 1.0
+COMPUTE_WAIT_INTERVAL = 0.05
+
+
+def get_cache(alias=None):
+    """ Returns shared instance of the cache backend, the one keeping
+    generations by default.
+    """
+    alias = alias or CACHE_GENERATION_ALIAS
+    backend = _caches.get(alias)
+    if backend is None:
+        backend = _caches.setdefault(alias, cache.get_cache(alias))
+    return backend
+
+
+def _get_digest(name):
+    digest = getattr(hashlib, name, None)
+    if digest is None and name.startswith('blake2'):
+        try:
+            import pyblake2
+        except ImportError:
+            pass
+        else:
+            digest = getattr(pyblake2, name, None)
+    if digest is None:
+        raise ImproperlyConfigured(
+            "CACHE_KEY_DIGEST '%s' is not available" % name)
+    if name.startswith('blake2'):
+        # 128 bits, same length of the keys as with md5
+        digest = functools.partial(digest, digest_size=16)
+    return digest
+
+
+_digest = _get_digest(CACHE_KEY_DIGEST)
+
+
+def user_namespace(user):
+    """ Returns generation namespace of the *user* (or user ID), None for
+    anonymous users.
+    """
+    pk = getattr(user, 'pk', user)
+    if pk is None:
+        return None
+    return 'user:%s' % pk
+
+
+def model_namespace(model):
+    """ Returns generation namespace of the *model* class or instance. """
+    opts = model._meta
+    return 'model:%s.%s' % (opts.app_label, opts.object_name.lower())
+
+
+def tag_namespace(tag):
+    """ Returns generation namespace of an arbitrary *tag*. """
+    return 'tag:%s' % tag
+
+
+def _generation_key(namespace):
+    if namespace is None:
+        return CACHE_GENERATION_KEY
+    return '%s/%s' % (CACHE_GENERATION_KEY, namespace)
+
+
+def _remember_generations(generations):
+    expires = time.time() + CACHE_GENERATION_TTL
+    with _generations_lock:
+        for namespace, gen in generations.items():
+            _generations.pop(namespace, None)
+            _generations[namespace] = (gen, expires)
+        while len(_generations) > CACHE_GENERATION_LOCAL_SIZE:
+            _generations.popitem(last=False)
+    snapshot = getattr(_local, 'generations', None)
+    if snapshot is not None:
+        snapshot.update(generations)
+
+
+def _fetch_generations(namespaces):
+    backend = get_cache()
+    keys = dict((_generation_key(namespace), namespace)
+        for namespace in namespaces)
+    found = backend.get_many(list(keys))
+    generations = {}
+    for key, namespace in keys.items():
+        gen = found.get(key)
+        if not gen:
+            # starting from the current time keeps keys of the generations
+            # lost with the evicted counter from becoming valid again
+            gen = int(time.time())
+            if not backend.add(key, gen, None):
+                gen = backend.get(key) or gen
+        generations[namespace] = gen
+    _remember_generations(generations)
+    return generations
+
+
+def get_generations(namespaces):
+    """ Returns dict of current generations of the *namespaces* (None
+    stands for the global one).
+
+    Generations snapshotted for the current request are used if any,
+    otherwise the ones remembered in the process, if they are not older
+    than ``CACHE_GENERATION_TTL`` seconds.  All other generations are
+    fetched with a single ``get_many``.
+    """
+    snapshot = getattr(_local, 'generations', None)
+    now = time.time()
+    generations = {}
+    missing = []
+    for namespace in namespaces:
+        gen = snapshot.get(namespace) if snapshot else None
+        if gen is None:
+            gen, expires = _generations.get(namespace, (None, 0))
+            if gen is None or expires <= now:
+                missing.append(namespace)
+                continue
+            if snapshot is not None:
+                snapshot[namespace] = gen
+        generations[namespace] = gen
+    if missing:
+        generations.update(_fetch_generations(missing))
+    return generations
+
+
+def get_generation():
+    """ Returns current global cache generation. """
+    return get_generations([None])[None]
+
+
+def snapshot_generation():
+    """ Makes :func:`get_generations` return the same values in the current
+    thread until :func:`release_generation` is called.
+    """
+    _local.generations = None
+    gen = get_generation()
+    _local.generations = {None: gen}
+    return gen
+
+
+def release_generation():
+    """ Stops using the generations snapshotted by
+    :func:`snapshot_generation`.
+    """
+    _local.generations = None
+
+
+def _get_namespaces(user=None, models=(), tags=()):
+    namespaces = [None]
+    if user is not None:
+        namespace = user_namespace(user)
+        if namespace is not None:
+            namespaces.append(namespace)
+    namespaces.extend(model_namespace(model) for model in models)
+    namespaces.extend(tag_namespace(tag) for tag in tags)
+    return namespaces
 
-def make_cache_key(key, user=None):
-    from hashlib import md5
-    gen = memcache.get(CACHE_GENERATION_KEY)
-    if not gen:
-        gen = 1
-        memcache.set(CACHE_GENERATION_KEY, gen)
-    from logging import info
-    info("generation in model cache: %s", memcache.get(CACHE_GENERATION_KEY))
-    return md5('%s/%d/%s' % (CACHE_KEY, gen, str(key))).hexdigest()
+
+def get_version(user=None, models=(), tags=()):
+    """ Returns version string made of all generations a key depends on.
+    """
+    namespaces = _get_namespaces(user, models, tags)
+    generations = get_generations(namespaces)
+    version = '.'.join(['%d' % generations[namespace]
+        for namespace in namespaces])
+    if user is not None and user_namespace(user) is not None:
+        # keys of different users must differ, not only their versions
+        version = '%s/%s' % (version, user_namespace(user))
+    return version
+
+
+def make_cache_key(key, user=None, models=(), tags=()):
+    """ Returns cache key for *key*, which becomes stale after global
+    invalidation or invalidation of the *user*, any of the *models* or
+    *tags*.  Keys of different authenticated users are different.
+    """
+    version = get_version(user, models, tags)
+    return _digest('%s/%s/%s' % (CACHE_KEY, version, str(key))).hexdigest()
+
+
+def make_cache_keys(keys, user=None, models=(), tags=()):
+    """ Same as :func:`make_cache_key`, but for many keys at once: returns
+    dict mapping *keys* to cache keys.  Generations are looked up only
+    once for all of them.
+    """
+    prefix = _digest('%s/%s/' % (CACHE_KEY, get_version(user, models, tags)))
+    cache_keys = {}
+    for key in keys:
+        digest = prefix.copy()
+        digest.update(str(key))
+        cache_keys[key] = digest.hexdigest()
+    return cache_keys
+
+
+def cache_get_many(keys, user=None, models=(), tags=(), alias=None):
+    """ Fetches values of *keys* made with :func:`make_cache_keys` with a
+    single request to the cache.  Returns dict mapping found keys to their
+    values.
+
+    Usage::
+
+        cached = cache_get_many(item_ids, user=request.user)
+        missing = [pk for pk in item_ids if pk not in cached]
+    """
+    cache_keys = make_cache_keys(keys, user, models, tags)
+    found = get_cache(alias).get_many(list(cache_keys.values()))
+    return dict((key, found[cache_key])
+        for key, cache_key in cache_keys.items() if cache_key in found)
+
+
+def cache_set_many(data, timeout=DEFAULT_TIMEOUT, user=None, models=(),
+        tags=(), alias=None):
+    """ Stores values of the *data* dict under keys made with
+    :func:`make_cache_keys`, with a single request to the cache.
+    """
+    cache_keys = make_cache_keys(data, user, models, tags)
+    get_cache(alias).set_many(dict((cache_keys[key], value)
+        for key, value in data.items()), timeout)
+
+
+def get_or_compute(key, func, ttl, user=None, models=(), tags=(),
+        alias=None, beta=1.0, grace=None, lock_timeout=COMPUTE_LOCK_TIMEOUT,
+        wait=COMPUTE_WAIT):
+    """ Returns cached value of the *key*, calling *func* to compute and
+    store it for *ttl* seconds when needed, protected from stampedes.
+
+    Time the computation takes is stored with the value, and the value is
+    recomputed a bit earlier than it expires, with probability growing as
+    the expiration time approaches ("XFetch", Vattani et al., 2015); *beta*
+    above 1 favors earlier recomputation.  Only one process recomputes the
+    value at a time, holding :class:`~mcutils.django.lock.mutually_exclusive`
+    lock; the others keep returning the current value, which is kept in
+    the cache *grace* seconds (*ttl* by default) after it expires.  On miss
+    they wait up to *wait* seconds for the value and compute it themselves
+    if it does not appear.
+
+    Usage::
+
+        stats = get_or_compute('stats', compute_stats, 300, models=[Order])
+    """
+    cache_key = make_cache_key(key, user, models, tags)
+    backend = get_cache(alias)
+
+    def compute():
+        start = time.time()
+        value = func()
+        delta = time.time() - start
+        backend.set(cache_key, (value, delta, time.time() + ttl),
+            ttl + (ttl if grace is None else grace))
+        return value
+
+    entry = backend.get(cache_key)
+    if entry is not None:
+        value, delta, expires = entry
+        if time.time() - delta * beta * math.log(
+                1.0 - random.random()) < expires:
+            return value
+
+    lock = mutually_exclusive(cache_key + '/lock', lock_timeout,
+        backend=backend)
+    try:
+        with lock:
+            return compute()
+    except MutexError:
+        if entry is not None:
+            return entry[0]
+    deadline = time.time() + wait
+    while time.time() < deadline:
+        time.sleep(COMPUTE_WAIT_INTERVAL)
+        entry = backend.get(cache_key)
+        if entry is not None:
+            return entry[0]
+    return compute()
+
+
+def _bump_generation(namespace):
+    backend = get_cache()
+    try:
+        gen = backend.incr(_generation_key(namespace))
+    except ValueError:
+        gen = _fetch_generations([namespace])[namespace]
+    _remember_generations({namespace: gen})
+    logger.debug("generation in model cache: %s %s", namespace or '', gen)
+    return gen
 
 
 def invalidate_cache():
-    gen = memcache.get(CACHE_GENERATION_KEY)
-    if not gen:
-        gen = 1
-        memcache.set(CACHE_GENERATION_KEY, gen)
-    else:
-        memcache.incr(CACHE_GENERATION_KEY)
-    from logging import info
-    info("generation in model cache: %s", memcache.get(CACHE_GENERATION_KEY))
+    """ Makes all keys stale. """
+    _bump_generation(None)
 
 
 def invalidate_user_cache(user):
-    pass
+    """ Makes keys of the *user* stale. """
+    namespace = user_namespace(user)
+    if namespace is not None:
+        _bump_generation(namespace)
+
+
+def invalidate_model_cache(model):
+    """ Makes keys depending on the *model* stale. """
+    _bump_generation(model_namespace(model))
+
+
+def invalidate_tag_cache(tag):
+    """ Makes keys depending on the *tag* stale. """
+    _bump_generation(tag_namespace(tag))
+
+
+class TwoTierCache(object):
+    """ Cache of hot values in the process (L1) in front of the Django
+    cache (L2).
+
+    Values are stored under keys made with :func:`make_cache_key`, so L1
+    entries become stale with the generations: after
+    :func:`invalidate_cache` (or invalidation of a user, model or tag) on
+    any node, the key changes as soon as the node learns the new
+    generation.  Values overwritten on other nodes without invalidation
+    are seen after at most *ttl* seconds.
+
+    :param alias: alias of the L2 cache, the one keeping generations by
+        default.
+    :param maxsize: maximum number of values kept in L1, least recently
+        used ones are dropped first.
+    :param ttl: number of seconds values are kept in L1.
+
+    Usage::
+
+        flags = TwoTierCache(ttl=10)
+
+        def get_flags(site):
+            value = flags.get(site.pk, models=[Flag])
+            if value is None:
+                value = list(Flag.objects.filter(site=site))
+                flags.set(site.pk, value, 300, models=[Flag])
+            return value
+    """
+
+    def __init__(self, alias=None, maxsize=LOCAL_CACHE_SIZE,
+            ttl=LOCAL_CACHE_TTL):
+        self.alias = alias
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._values = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.clear_stats()
+
+    def _get_local(self, cache_key):
+        with self._lock:
+            item = self._values.pop(cache_key, None)
+            if item is None:
+                return _missing
+            if item[1] <= time.time():
+                return _missing
+            self._values[cache_key] = item
+            self.l1_hits += 1
+        return item[0]
+
+    def _set_local(self, cache_key, value):
+        with self._lock:
+            self._values.pop(cache_key, None)
+            self._values[cache_key] = (value, time.time() + self.ttl)
+            while len(self._values) > self.maxsize:
+                self._values.popitem(last=False)
+
+    def _count_remote(self, hits, misses):
+        with self._lock:
+            self.l2_hits += hits
+            self.misses += misses
+
+    def get(self, key, default=None, user=None, models=(), tags=()):
+        """ Returns value of the *key*, or *default* when it is not cached.
+        """
+        cache_key = make_cache_key(key, user, models, tags)
+        value = self._get_local(cache_key)
+        if value is not _missing:
+            return value
+        value = get_cache(self.alias).get(cache_key, _missing)
+        if value is _missing:
+            self._count_remote(0, 1)
+            return default
+        self._count_remote(1, 0)
+        self._set_local(cache_key, value)
+        return value
+
+    def get_many(self, keys, user=None, models=(), tags=()):
+        """ Returns dict mapping found *keys* to their values, fetching
+        values missing in L1 with a single request to L2.
+        """
+        cache_keys = make_cache_keys(keys, user, models, tags)
+        values = {}
+        remote_keys = {}
+        for key, cache_key in cache_keys.items():
+            value = self._get_local(cache_key)
+            if value is _missing:
+                remote_keys[cache_key] = key
+            else:
+                values[key] = value
+        if remote_keys:
+            found = get_cache(self.alias).get_many(list(remote_keys))
+            for cache_key, value in found.items():
+                self._set_local(cache_key, value)
+                values[remote_keys[cache_key]] = value
+            self._count_remote(len(found), len(remote_keys) - len(found))
+        return values
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, user=None,
+            models=(), tags=()):
+        """ Stores *value* in both L1 and L2. """
+        cache_key = make_cache_key(key, user, models, tags)
+        get_cache(self.alias).set(cache_key, value, timeout)
+        self._set_local(cache_key, value)
+
+    def delete(self, key, user=None, models=(), tags=()):
+        """ Deletes value from L2 and from L1 of this process only, other
+        processes keep it for up to *ttl* seconds.
+        """
+        cache_key = make_cache_key(key, user, models, tags)
+        get_cache(self.alias).delete(cache_key)
+        with self._lock:
+            self._values.pop(cache_key, None)
+
+    def clear_local(self):
+        """ Drops all values kept in L1. """
+        with self._lock:
+            self._values.clear()
+
+    def clear_stats(self):
+        with self._lock:
+            self.l1_hits = self.l2_hits = self.misses = 0
+
+    def get_stats(self):
+        """ Returns dict of hit counters and ratios: *l1_hit_ratio* is the
+        share of lookups served from the process, *l2_hit_ratio* is the
+        share of lookups passed to L2 that were found there.
+        """
+        with self._lock:
+            l1_hits, l2_hits, misses = (
+                self.l1_hits, self.l2_hits, self.misses)
+        lookups = l1_hits + l2_hits + misses
+        remote_lookups = l2_hits + misses
+        return {
+            'l1_hits': l1_hits,
+            'l2_hits': l2_hits,
+            'misses': misses,
+            'size': len(self._values),
+            'l1_hit_ratio': l1_hits * 1.0 / lookups if lookups else 0.0,
+            'l2_hit_ratio': (
+                l2_hits * 1.0 / remote_lookups if remote_lookups else 0.0),
+        }
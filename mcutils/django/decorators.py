@@ -1,12 +1,16 @@
 from functools import wraps
+from hashlib import md5
 
 from django.conf import settings
-from django.http import Http404, HttpResponse, HttpResponseForbidden
+from django.http import (Http404, HttpResponse, HttpResponseForbidden,
+    HttpResponseNotModified)
 from django.utils import simplejson
+from django.utils.http import parse_etags, quote_etag
 
 __all__ = (
     'ajax_only', 'ajax_login_required', 'ajax_template', 'auth_user_only',
-    'debug_only', 'render_to_json_response', 'super_user_only',
+    'cache_json_response', 'debug_only', 'render_to_json_response',
+    'super_user_only',
 )
 
 
@@ -99,6 +103,9 @@ def render_to_json_response(*fn, **jsonargs):
             def json_view(request):
                 return { 'foo': 'bar' }
     """
+    jsonargs = dict(jsonargs)
+    encoder = jsonargs.pop('encoder', None)
+
     def internal(view_func):
         @wraps(view_func)
         def wrapper(request, *args, **kwargs):
@@ -113,7 +120,6 @@ def render_to_json_response(*fn, **jsonargs):
             ret = HttpResponse(mimetype=_JSON_MIME_TYPE)
             if status_code:
                 ret.status_code = status_code
-            encoder = jsonargs.pop('encoder', None)
             ret.write(simplejson.dumps(response, cls=encoder, **jsonargs))
             return ret
         return wrapper
@@ -122,6 +128,92 @@ def render_to_json_response(*fn, **jsonargs):
     return internal
 
 
+def cache_json_response(*fn, **options):
+    """ Render response as JSON like `render_to_json_response` does and
+        cache the serialized body under a generation key (see
+        `mcutils.django.cache.make_cache_key`).
+
+        Responses carry a strong ETag of the cached body, requests with
+        matching `If-None-Match` header get 304 response without calling
+        the view.  Only responses to GET and HEAD requests are cached,
+        `HttpResponse` objects returned by the view are passed as is.
+
+        :param timeout: number of seconds the body is cached.
+        :param per_user: cache separately for every authenticated user.
+        :param key_func: function called with the view arguments which
+            returns the key, name of the view and full path of the request
+            by default.
+        :param models: models the response depends on.
+        :param tags: tags the response depends on.
+        :param alias: alias of the cache.
+        :param jsonargs: arguments passed to `render_to_json_response`.
+
+        Usage::
+
+            @cache_json_response(timeout=60, per_user=True)
+            def unread_count(request):
+                return {'count': request.user.messages.unread().count()}
+    """
+    from mcutils.django.cache import (DEFAULT_TIMEOUT, get_cache,
+        make_cache_key)
+
+    timeout = options.pop('timeout', DEFAULT_TIMEOUT)
+    per_user = options.pop('per_user', False)
+    key_func = options.pop('key_func', None)
+    models = options.pop('models', ())
+    tags = options.pop('tags', ())
+    alias = options.pop('alias', None)
+
+    render = render_to_json_response(**options)(
+        lambda request, data, **kwargs: data)
+
+    def internal(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            # status is passed the same way render_to_json_response takes it
+            status = {}
+            if 'status' in kwargs:
+                status['status'] = kwargs['status']
+            if request.method not in ('GET', 'HEAD'):
+                return render(request, view_func(request, *args, **kwargs),
+                    **status)
+            if key_func is None:
+                key = '%s.%s:%s' % (view_func.__module__,
+                    view_func.__name__, request.get_full_path())
+            else:
+                key = key_func(request, *args, **kwargs)
+            user = None
+            if per_user and request.user.is_authenticated():
+                user = request.user
+            cache_key = make_cache_key(key, user, models, tags)
+            backend = get_cache(alias)
+            entry = backend.get(cache_key)
+            if entry is None:
+                data = view_func(request, *args, **kwargs)
+                if isinstance(data, HttpResponse):
+                    return data
+                response = render(request, data, **status)
+                content = response.content
+                status_code = response.status_code
+                etag = md5(cache_key + content).hexdigest()
+                backend.set(cache_key, (etag, content, status_code),
+                    timeout)
+            else:
+                etag, content, status_code = entry
+            if etag in parse_etags(
+                    request.META.get('HTTP_IF_NONE_MATCH', '')):
+                response = HttpResponseNotModified()
+            else:
+                response = HttpResponse(content, status=status_code,
+                    content_type=_JSON_MIME_TYPE)
+            response['ETag'] = quote_etag(etag)
+            return response
+        return wrapper
+    if len(fn) > 0 and callable(fn[0]):
+        return internal(fn[0])
+    return internal
+
+
 def super_user_only(view_func):
     def wrap(request, *args, **kwargs):
         if request.user.is_authenticated() and request.user.is_superuser:
@@ -1,20 +1,45 @@
 from __future__ import unicode_literals
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
 from django.utils import six
-from mcutils.django import model_uid_generator
+from mcutils import random_in_range_many
+from mcutils.django import model_uid_generator, snowflake_uid_generator
+
+
+# number of attempts to insert rows with optimistic UIDs
+UID_INSERT_RETRIES = 5
+
+# maximum number of values in a single ``__in`` lookup
+UID_QUERY_CHUNK_SIZE = 500
 
 
 class UidIntegerField(models.BigIntegerField):
+    """ Unique integer field filled with random values.
+
+    With ``time_ordered=True`` values are time-ordered instead (see
+    :mod:`mcutils.snowflake`): they keep index locality and do not need
+    a uniqueness query, ``min_value`` and ``max_value`` are ignored then.
+
+    With ``optimistic=True`` random values are assigned without a
+    uniqueness query, the model should inherit :class:`OptimisticUidMixin`
+    to retry inserts which violate the unique constraint.  Use
+    :func:`bulk_create_with_uids` to insert many objects at once.
+    """
     def __init__(self, model_class, **kwargs):
         self.model_class = model_class
-        self.min_value = kwargs.pop('min_value')
+        self.time_ordered = kwargs.pop('time_ordered', False)
+        self.optimistic = kwargs.pop('optimistic', False)
+        self.min_value = kwargs.pop('min_value', 0)
         self.max_value = kwargs.pop('max_value', self.MAX_BIGINT)
         self.field_name = kwargs.pop('field_name', 'pk')
         kwargs.setdefault('unique', True)
         kwargs.setdefault('editable', False)
-        kwargs.setdefault('default', model_uid_generator(
-            self.model_class, max_value=self.max_value,
-            min_value=self.min_value, field_name=self.field_name))
+        if self.time_ordered:
+            kwargs.setdefault('default', snowflake_uid_generator)
+        else:
+            kwargs.setdefault('default', model_uid_generator(
+                self.model_class, max_value=self.max_value,
+                min_value=self.min_value, field_name=self.field_name,
+                optimistic=self.optimistic))
         super(UidIntegerField, self).__init__(**kwargs)
 
     def value_to_string(self, obj):
@@ -33,11 +58,153 @@ class UidIntegerField(models.BigIntegerField):
             kwargs['max_value'] = self.max_value
         if self.field_name != 'pk':
             kwargs['field_name'] = six.text_type(self.field_name)
+        if self.time_ordered:
+            kwargs['time_ordered'] = True
+        if self.optimistic:
+            kwargs['optimistic'] = True
         default = kwargs.get('default')
         if callable(default):
             kwargs['default'] = default()
         return name, path, args, kwargs
 
+
+def _get_uid_fields(model_class, optimistic_only=False):
+    return [field for field in model_class._meta.local_fields
+            if isinstance(field, UidIntegerField) and not field.time_ordered
+            and (field.optimistic or not optimistic_only)]
+
+
+def _get_taken_uids(model_class, field, values, using):
+    """ Returns set of *values* already stored in the *field*. """
+    values = list(values)
+    queryset = model_class._default_manager.using(using)
+    taken = set()
+    for i in range(0, len(values), UID_QUERY_CHUNK_SIZE):
+        taken.update(queryset.filter(**{
+            '%s__in' % field.name: values[i:i + UID_QUERY_CHUNK_SIZE],
+        }).values_list(field.name, flat=True))
+    return taken
+
+
+def assign_uids(objs, using=None, fields=None):
+    """ Makes values of `UidIntegerField` fields of *objs* unique.
+
+    Values already assigned are checked with a single ``__in`` query per
+    `UID_QUERY_CHUNK_SIZE` objects, only missing, duplicated and already
+    taken values are replaced by random ones (which are checked the same
+    way).  Returns number of replaced values.
+    """
+    if not objs:
+        return 0
+    model_class = objs[0].__class__
+    using = using or router.db_for_write(model_class)
+    if fields is None:
+        fields = _get_uid_fields(model_class)
+    replaced = 0
+    for field in fields:
+        attname = field.attname
+        values = [getattr(obj, attname) for obj in objs]
+        taken = _get_taken_uids(model_class, field,
+            set(value for value in values if value is not None), using)
+        seen = set()
+        pending = []
+        for obj, value in zip(objs, values):
+            if value is None or value in seen or value in taken:
+                pending.append(obj)
+            else:
+                seen.add(value)
+        replaced += len(pending)
+        while pending:
+            candidates = set(random_in_range_many(len(pending),
+                min_value=field.min_value, max_value=field.max_value))
+            candidates.difference_update(seen)
+            candidates.difference_update(
+                _get_taken_uids(model_class, field, candidates, using))
+            for value in candidates:
+                if not pending:
+                    break
+                setattr(pending.pop(), attname, value)
+                seen.add(value)
+    return replaced
+
+
+def bulk_create_with_uids(objs, batch_size=None, using=None,
+        retries=UID_INSERT_RETRIES):
+    """ Inserts *objs* with ``bulk_create``, making values of their
+    `UidIntegerField` fields unique beforehand (see :func:`assign_uids`).
+
+    A batch rejected because of values taken concurrently is retried
+    with colliding values re-rolled.  Inserted values are added to the
+    :class:`~mcutils.django.UidOccupancyIndex` of the field's default
+    generator, as ``bulk_create`` does not send ``post_save``.
+
+    Usage::
+
+        bulk_create_with_uids([Entry(title=title) for title in titles])
+    """
+    objs = list(objs)
+    if not objs:
+        return objs
+    model_class = objs[0].__class__
+    using = using or router.db_for_write(model_class)
+    assign_uids(objs, using)
+    for attempt in range(retries):
+        try:
+            with transaction.atomic(using=using):
+                objs = model_class._default_manager.using(
+                    using).bulk_create(objs, batch_size=batch_size)
+            break
+        except IntegrityError:
+            if attempt + 1 >= retries or not assign_uids(objs, using):
+                raise
+    for field in _get_uid_fields(model_class):
+        index = getattr(field.default, 'occupancy_index', None)
+        if index is not None:
+            index.add(getattr(obj, field.attname) for obj in objs)
+    return objs
+
+
+class OptimisticUidMixin(object):
+    """ Model mixin which retries insertion of a new row with fresh values
+    of ``UidIntegerField(optimistic=True)`` fields when a unique constraint
+    is violated.  Every attempt is made inside a savepoint.  New rows are
+    always inserted (unless ``force_update`` is passed), so a colliding
+    value never updates an existing row when the field is the primary key.
+
+    Usage::
+
+        class Entry(OptimisticUidMixin, models.Model):
+            uid = UidIntegerField('blog.Entry', optimistic=True)
+    """
+    uid_insert_retries = UID_INSERT_RETRIES
+
+    def save(self, *args, **kwargs):
+        fields = _get_uid_fields(self.__class__, optimistic_only=True)
+        if not (fields and self._state.adding):
+            return super(OptimisticUidMixin, self).save(*args, **kwargs)
+        kwargs.update(zip(
+            ('force_insert', 'force_update', 'using', 'update_fields'), args))
+        if not (kwargs.get('force_update') or kwargs.get('update_fields')):
+            # a primary key value is set before saving, Django would update
+            # the colliding row instead of failing to insert a new one
+            kwargs['force_insert'] = True
+        using = kwargs.get('using') or router.db_for_write(
+            self.__class__, instance=self)
+        for attempt in range(self.uid_insert_retries):
+            try:
+                with transaction.atomic(using=using):
+                    return super(OptimisticUidMixin, self).save(**kwargs)
+            except IntegrityError:
+                if attempt + 1 >= self.uid_insert_retries:
+                    raise
+                collided = [field for field in fields
+                            if _get_taken_uids(self.__class__, field,
+                                [getattr(self, field.attname)], using)]
+                if not collided:
+                    raise
+                for field in collided:
+                    setattr(self, field.attname, field.get_default())
+
 try:
     from south.modelsinspector import add_introspection_rules
     add_introspection_rules([
@@ -45,6 +212,8 @@ try:
             'model_class': ['model_class', {}],
             'field_name': ['field_name', {'default': 'pk'}],
             'min_value': ['min_value', {'default': 0}],
+            'time_ordered': ['time_ordered', {'default': False}],
+            'optimistic': ['optimistic', {'default': False}],
         })
     ], ['^mcutils\.django\.fields\.UidIntegerField'])
 except ImportError:
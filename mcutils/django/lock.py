@@ -13,19 +13,21 @@ class MutexError(Exception):
 
 class mutually_exclusive(object):
     def __init__(self, lock_id, timeout=None, cache_alias=None,
-                 fail_silently=False):
+                 fail_silently=False, backend=None):
         self.lock_id = lock_id
         self.fail_silently = fail_silently
         self.timeout = timeout
-        self.cache = cache.get_cache(cache_alias or cache.DEFAULT_CACHE_ALIAS)
+        if backend is None:
+            backend = cache.get_cache(cache_alias or cache.DEFAULT_CACHE_ALIAS)
+        self.cache = backend
 
     def __call__(self, func):
         return self.decorate_callable(func)
 
     def __enter__(self):
-        if self.cache.has_key(self.lock_id):
+        # add() is atomic, it fails if another process holds the lock
+        if not self.cache.add(self.lock_id, timezone.now(), self.timeout):
             raise MutexError('Could not acquire lock: {0}'.format(self.lock_id))
-        self.cache.add(self.lock_id, timezone.now(), self.timeout)
 
     def __exit__(self, *args):
         self.cache.delete(self.lock_id)
@@ -45,3 +45,19 @@ class RequireLoginMiddleware(object):
                 return login_required(view_func)(request,*view_args,**view_kwargs)
         # Explicitly return None for all non-matching requests
         return None
+
+
+class CacheGenerationMiddleware(object):
+    """ Middleware component that makes all keys of the request built with
+        mcutils.django.cache.make_cache_key use the same cache generation,
+        fetched at most once per request. Add the class to
+        MIDDLEWARE_CLASSES before any middleware using the cache.
+    """
+    def process_request(self, request):
+        from mcutils.django.cache import snapshot_generation
+        snapshot_generation()
+
+    def process_response(self, request, response):
+        from mcutils.django.cache import release_generation
+        release_generation()
+        return response
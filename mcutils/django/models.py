@@ -24,3 +24,110 @@ def load_fixture(file_name, orm):
     models.get_model = get_model_southern_style
     call_command('loaddata', file_name)
     models.get_model = original_get_model
+
+
+class PublicId(object):
+    """ Opaque public identifier derived from the primary key with a keyed
+    permutation (see :mod:`mcutils.permutation`), so that sequential keys
+    can be exposed without being guessable and without storing another
+    unique column.
+
+    The key is derived from ``SECRET_KEY`` and the model name unless
+    given.  Use :class:`PublicIdManager` to look objects up by the public
+    identifier, it is decoded to a primary key query.
+
+    Usage::
+
+        class Entry(models.Model):
+            public_id = PublicId(bits=32)
+
+            objects = PublicIdManager()
+
+        entry = Entry.objects.get(public_id='3MTGgv')
+        entry.public_id  # '3MTGgv'
+    """
+    def __init__(self, bits=32, key=None, rounds=4, alphabet=None):
+        self.bits = bits
+        self.key = key
+        self.rounds = rounds
+        self.alphabet = alphabet
+        self._permutation = None
+
+    def contribute_to_class(self, cls, name):
+        self.name = name
+        self.model = cls
+        setattr(cls, name, self)
+
+    @property
+    def permutation(self):
+        if self._permutation is None:
+            from mcutils import BASE62
+            from mcutils.permutation import FeistelPermutation
+            key = self.key
+            if key is None:
+                from django.conf import settings
+                key = '%s:mcutils.public_id:%s.%s' % (settings.SECRET_KEY,
+                    self.model._meta.app_label, self.model._meta.object_name)
+            self._permutation = FeistelPermutation(key, bits=self.bits,
+                rounds=self.rounds, alphabet=self.alphabet or BASE62)
+        return self._permutation
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if instance.pk is None:
+            return None
+        return self.encode(instance.pk)
+
+    def encode(self, pk):
+        """ Returns public identifier for the primary key. """
+        return self.permutation.encode_str(pk)
+
+    def decode(self, value):
+        """ Returns primary key for the public identifier or None if it is
+        invalid.
+        """
+        try:
+            return self.permutation.decode_str(value)
+        except (TypeError, ValueError):
+            return None
+
+
+class PublicIdQuerySet(models.query.QuerySet):
+    """ QuerySet which translates ``exact`` and ``in`` lookups of
+    :class:`PublicId` attributes into primary key lookups.
+    """
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        # primary key lookups are added as separate conditions, so they are
+        # combined with ``pk`` lookups given by the caller
+        args = list(args)
+        for lookup in list(kwargs):
+            name, _, lookup_type = lookup.partition('__')
+            public_id = getattr(self.model, name, None)
+            if not isinstance(public_id, PublicId):
+                continue
+            value = kwargs.pop(lookup)
+            if lookup_type in ('', 'exact'):
+                pk = public_id.decode(value)
+                if pk is None:
+                    args.append(models.Q(pk__in=[]))
+                else:
+                    args.append(models.Q(pk=pk))
+            elif lookup_type == 'in':
+                pks = [public_id.decode(item) for item in value]
+                args.append(models.Q(
+                    pk__in=[pk for pk in pks if pk is not None]))
+            else:
+                raise TypeError("unsupported lookup '%s' for %s" % (
+                    lookup_type, name))
+        return super(PublicIdQuerySet, self)._filter_or_exclude(
+            negate, *args, **kwargs)
+
+
+class PublicIdManager(models.Manager):
+    """ Manager for models with :class:`PublicId` attributes. """
+    def get_queryset(self):
+        return PublicIdQuerySet(self.model, using=self._db)
+
+    # Django < 1.6
+    get_query_set = get_queryset
@@ -0,0 +1,108 @@
+""" Keyed reversible permutation of integers (format-preserving encryption).
+
+    Maps integers of a given bit width to integers of the same width, one
+    to one, using a balanced Feistel network with HMAC-SHA256 round
+    function (cycle walking is used for odd widths).  Sequential values,
+    like auto-increment primary keys, become opaque and can be turned back
+    without any lookup.
+
+    Usage::
+
+        from mcutils.permutation import FeistelPermutation
+
+        perm = FeistelPermutation(settings.SECRET_KEY, bits=32)
+        public_id = perm.encode_str(entry.pk)  # e.g. '3Zq0Tb'
+        pk = perm.decode_str(public_id)
+"""
+import binascii
+import hashlib
+import hmac
+import struct
+
+from . import BASE62, get_numconv
+
+__all__ = ['FeistelPermutation']
+
+
+class FeistelPermutation(object):
+    """ Keyed permutation of integers in ``[0, 2 ** bits)``.
+
+        It hides the order of values, it is not meant to protect secrets:
+        use a key which is not used for anything else.
+
+        :param key: secret key, a string.
+        :param bits: width of the values, from 2 to 128 bits.
+        :param rounds: number of Feistel rounds.
+        :param alphabet: alphabet used by :meth:`encode_str` and
+            :meth:`decode_str`.
+
+        :raise ValueError: when *bits* is out of range
+    """
+
+    def __init__(self, key, bits=32, rounds=4, alphabet=BASE62):
+        if not 2 <= bits <= 128:
+            raise ValueError('bits must be >= 2 and <= 128')
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        self.bits = bits
+        self.rounds = rounds
+        self.half_bits = (bits + 1) // 2
+        self.conv = get_numconv(len(alphabet), alphabet)
+        self._mask = 2 ** self.half_bits - 1
+        self._round_keys = [
+            hmac.new(key, ('round %d' % i).encode('ascii'),
+                     hashlib.sha256).digest()
+            for i in range(rounds)]
+
+    def _f(self, i, value):
+        digest = hashlib.sha256(self._round_keys[i] + struct.pack(
+            '>QQ', value >> 64, value & 0xffffffffffffffff)).digest()
+        return int(binascii.hexlify(digest), 16) & self._mask
+
+    def _forward(self, value):
+        half, mask = self.half_bits, self._mask
+        left, right = value >> half, value & mask
+        for i in range(self.rounds):
+            left, right = right, left ^ self._f(i, right)
+        return (left << half) | right
+
+    def _backward(self, value):
+        half, mask = self.half_bits, self._mask
+        left, right = value >> half, value & mask
+        for i in reversed(range(self.rounds)):
+            left, right = right ^ self._f(i, left), left
+        return (left << half) | right
+
+    def _check(self, value):
+        if int(value) != value:
+            raise TypeError('value must be an integer')
+        if not 0 <= value < 2 ** self.bits:
+            raise ValueError('value must be >= 0 and < 2 ** %d' % self.bits)
+
+    def encode(self, value):
+        """ Maps integer *value* to its opaque counterpart. """
+        self._check(value)
+        value = self._forward(value)
+        # cycle walking: the network permutes 2 * half_bits wide values
+        while value >> self.bits:
+            value = self._forward(value)
+        return value
+
+    def decode(self, value):
+        """ Maps value returned by :meth:`encode` back. """
+        self._check(value)
+        value = self._backward(value)
+        while value >> self.bits:
+            value = self._backward(value)
+        return value
+
+    def encode_str(self, value):
+        """ Same as :meth:`encode`, but returns a string. """
+        return self.conv.int2str(self.encode(value))
+
+    def decode_str(self, text):
+        """ Same as :meth:`decode`, but takes a string.
+
+            :raise ValueError: when *text* is invalid
+        """
+        return self.decode(self.conv.str2int(text))
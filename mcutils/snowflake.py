@@ -0,0 +1,174 @@
+""" Time-ordered (k-sortable) 63-bit identifiers.
+
+    Identifiers are built the Twitter Snowflake way: milliseconds since
+    :data:`EPOCH` in the high bits, node identifier in the middle and
+    per-process sequence number in the low bits::
+
+        | 41 bits timestamp | 10 bits node | 12 bits sequence |
+
+    Values generated later are (almost) always greater, so rows inserted
+    with such keys are appended to the end of a B-tree index instead of
+    being scattered all over it.
+
+    Identifiers are unique only as long as every process generating them
+    at the same time has its own node identifier.  A fixed node identifier
+    can not be shared by forked processes, pass a callable which claims an
+    identifier in every process instead (see
+    :func:`mcutils.django.snowflake_uid_generator`, which leases them in
+    the Django cache).  Without a node identifier a random one is picked
+    in every process, which makes collisions unlikely only when a few
+    processes insert rows at the same millisecond; the sequence number
+    starts from a random value every millisecond to lower their chance
+    further.
+
+    Usage::
+
+        from mcutils.snowflake import get_snowflake_id, get_snowflake_id_str
+
+        pk = get_snowflake_id()
+        slug = get_snowflake_id_str()
+"""
+import os
+import threading
+import time
+
+from . import BASE62, _ProcessLocal, entropy_pool, get_numconv
+
+__all__ = ['SnowflakeGenerator', 'get_snowflake_id', 'get_snowflake_id_str',
+    'parse_snowflake_id']
+
+
+# 2015-01-01T00:00:00Z in milliseconds since the Unix epoch
+EPOCH = 1420070400000
+
+NODE_BITS = 10
+SEQUENCE_BITS = 12
+
+
+class SnowflakeGenerator(_ProcessLocal):
+    """ Callable which returns unique time-ordered integers.
+
+        :param node_id: identifier of the process, must be less than
+            ``2 ** node_bits``, or a callable returning it, which is called
+            again in a forked child process.  When not specified, a random
+            value is picked (and picked again in a forked child process).
+        :param epoch: start of the time scale, in milliseconds since the
+            Unix epoch.
+        :param node_bits: number of bits taken by *node_id*.
+        :param sequence_bits: number of bits taken by the sequence number.
+
+        The clock going backwards (e.g. NTP adjustments) never produces
+        duplicated values: the generator keeps using the last timestamp
+        until the clock catches up.  When the sequence number is exhausted
+        within a millisecond, the next millisecond is used in advance
+        rather than waiting for it.
+
+        :raise ValueError: when *node_id* does not fit *node_bits*
+        :raise RuntimeError: when the generator with fixed *node_id* is
+            used in a forked child process
+    """
+
+    def __init__(self, node_id=None, epoch=EPOCH, node_bits=NODE_BITS,
+            sequence_bits=SEQUENCE_BITS):
+        self.epoch = epoch
+        self.node_bits = node_bits
+        self.sequence_bits = sequence_bits
+        self.timestamp_bits = 63 - node_bits - sequence_bits
+        self.fixed_node_id = node_id
+        self._check_node_id(node_id)
+        self._check_pid()
+
+    def _check_node_id(self, node_id):
+        if (node_id is not None and not callable(node_id) and
+                not 0 <= node_id < 2 ** self.node_bits):
+            raise ValueError('node_id must be >= 0 and < %d' % (
+                2 ** self.node_bits, ))
+
+    def _reset(self):
+        node_id = self.fixed_node_id
+        if callable(node_id):
+            node_id = node_id()
+            self._check_node_id(node_id)
+        elif node_id is None:
+            node_id = entropy_pool.getrandint(2) % 2 ** self.node_bits
+        elif self._pid is not None and self._pid != os.getpid():
+            raise RuntimeError('node_id %d is used by a forked process, '
+                'pass a callable to claim a node_id in every process' % (
+                    node_id, ))
+        self.node_id = node_id
+        self._lock = threading.Lock()
+        self._last_timestamp = -1
+        self._sequence = self._first_sequence = 0
+
+    def reset(self):
+        """ Picks node identifier again, e.g. after its lease is lost. """
+        self._check_pid(force=True)
+
+    def _random_sequence(self):
+        return entropy_pool.getrandint(2) & (2 ** self.sequence_bits - 1)
+
+    def _time(self):
+        return int(time.time() * 1000) - self.epoch
+
+    def __call__(self):
+        self._check_pid()
+        with self._lock:
+            timestamp = self._time()
+            if timestamp <= self._last_timestamp:
+                timestamp = self._last_timestamp
+                self._sequence = (
+                    self._sequence + 1) & (2 ** self.sequence_bits - 1)
+                if self._sequence == self._first_sequence:
+                    timestamp += 1
+            else:
+                self._sequence = self._first_sequence = (
+                    self._random_sequence())
+            self._last_timestamp = timestamp
+            sequence = self._sequence
+        if timestamp >> self.timestamp_bits:
+            raise OverflowError('timestamp does not fit %d bits' % (
+                self.timestamp_bits, ))
+        return (((timestamp << self.node_bits) | self.node_id)
+                << self.sequence_bits) | sequence
+
+    def get_str(self, alphabet=None):
+        """ Get next identifier encoded to URL-safe string.
+
+            Strings are left padded with the zero digit to the same length,
+            so they are sorted the same way as integers if the *alphabet*
+            is sorted (like :data:`~mcutils.BASE62` is).
+        """
+        if not alphabet:
+            alphabet = BASE62
+        conv = get_numconv(len(alphabet), alphabet)
+        width = len(conv.int2str(2 ** 63 - 1))
+        return conv.int2str(self()).rjust(width, alphabet[0])
+
+    def parse(self, value):
+        """ Splits identifier into a tuple of timestamp (milliseconds since
+        the Unix epoch), node identifier and sequence number.
+        """
+        sequence = value & (2 ** self.sequence_bits - 1)
+        value >>= self.sequence_bits
+        node_id = value & (2 ** self.node_bits - 1)
+        return (value >> self.node_bits) + self.epoch, node_id, sequence
+
+
+default_generator = SnowflakeGenerator()
+
+
+def get_snowflake_id():
+    """ Get time-ordered integer suitable for database ID. """
+    return default_generator()
+
+
+def get_snowflake_id_str(alphabet=None):
+    """ Get time-ordered integer and encode it to URL-safe string. """
+    return default_generator.get_str(alphabet)
+
+
+def parse_snowflake_id(value):
+    """ Returns timestamp, node identifier and sequence number of the
+    identifier made by :func:`get_snowflake_id`.
+    """
+    return default_generator.parse(value)
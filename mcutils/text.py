@@ -0,0 +1,87 @@
+""" Fast transliteration to URL slugs.
+
+    :func:`slugify` returns the same as ``django.utils.text.slugify(
+    unidecode(value))`` but transliterates and cleans up the text with a
+    single ``translate`` call.  Every code point is mapped to the lowercase
+    ASCII characters it contributes to the slug; the mapping is prepared in
+    advance for common scripts (see :data:`PRELOADED_RANGES`) and computed
+    with ``unidecode`` on first use for all other code points.  Recently
+    slugified values are remembered, so repeated titles cost a dictionary
+    lookup.
+
+    Usage::
+
+        from mcutils.text import slugify
+
+        slugify(u'Hello, World!')  # u'hello-world'
+        slugify(u'\\u041f\\u0440\\u0438\\u0432\\u0435\\u0442')  # u'privet'
+"""
+import collections
+import re
+import threading
+
+from unidecode import unidecode
+
+__all__ = ['slugify']
+
+
+# number of recently slugified values remembered by slugify
+SLUGIFY_CACHE_SIZE = 1024
+
+# code point ranges mapped in advance: Basic Latin, Latin-1 Supplement,
+# Latin Extended-A and B, Greek and Coptic, Cyrillic and Cyrillic Supplement
+PRELOADED_RANGES = ((0x0000, 0x0250), (0x0370, 0x0530))
+
+# same characters as removed by django.utils.text.slugify from ASCII text
+_INVALID_RE = re.compile(r'[^0-9A-Za-z_ \t\n\r\f\v-]')
+_SPACE_RE = re.compile(r'[\t\n\r\f\v]')
+_SEPARATORS_RE = re.compile(r'[- ]+')
+
+
+class _SlugTable(dict):
+    """ ``translate`` table which maps code points on demand. """
+
+    def __missing__(self, codepoint):
+        text = unidecode(unichr(codepoint))
+        if not isinstance(text, unicode):
+            text = text.decode('ascii', 'ignore')
+        text = _SPACE_RE.sub(' ', _INVALID_RE.sub('', text)).lower()
+        self[codepoint] = text
+        return text
+
+
+_table = _SlugTable()
+for _start, _stop in PRELOADED_RANGES:
+    for _codepoint in range(_start, _stop):
+        _table[_codepoint]
+del _start, _stop, _codepoint
+
+_slugify_cache = collections.OrderedDict()
+_slugify_lock = threading.Lock()
+
+
+def _slugify(value):
+    if not isinstance(value, unicode):
+        value = unidecode(value)
+        if not isinstance(value, unicode):
+            value = value.decode('ascii', 'ignore')
+    value = value.translate(_table).strip(' ')
+    return _SEPARATORS_RE.sub('-', value)
+
+
+def slugify(value):
+    """ Transliterates *value* to ASCII, removes non-alphanumerics (except
+    underscores and hyphens), converts to lowercase and replaces spaces
+    with hyphens.
+    """
+    with _slugify_lock:
+        slug = _slugify_cache.pop(value, None)
+        if slug is not None:
+            _slugify_cache[value] = slug
+            return slug
+    slug = _slugify(value)
+    with _slugify_lock:
+        _slugify_cache[value] = slug
+        while len(_slugify_cache) > SLUGIFY_CACHE_SIZE:
+            _slugify_cache.popitem(last=False)
+    return slug